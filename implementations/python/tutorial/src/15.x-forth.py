@@ -6,17 +6,60 @@ include (compile-time-string -- ?) - includes the x-forth file at the given path
 include is more like a keyword than a normal word because it is actually executed between tokenization and interpretation. Its string argument must be known at compile time
 '''
 import traceback
+import contextlib
 import sys
 import os
 
+# options start with -- and can come before or after the source file
+options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+
+def option(name: str, default=None):
+    '''option returns the value of an option passed as --name=value, True if it was passed as just --name and default if it wasn't passed'''
+    for opt in options:
+        if opt == f'--{name}':
+            return True
+        if opt.startswith(f'--{name}='):
+            return opt[len(name)+3:]
+    return default
+
+# --stream tokenizes and interprets the source file and the files it includes lazily instead of reading them all up front
+stream = option('stream', False)
+# --engine=<name> picks what runs the program, see ENGINES
+# the vm is the fastest, but it has to compile everything before it starts so streaming defaults to the threaded engine
+engine = option('engine', 'threaded' if stream else 'vm')
+# --bench times each engine on a builtin program instead of running a file
+run_bench = option('bench', False)
+# --disassemble prints the vm's bytecode for the program instead of running it
+disassemble_only = option('disassemble', False)
+# --no-peephole turns off the bytecode optimizer, which can make disassembled programs easier to debug
+peephole = not option('no-peephole', False)
+# --no-fold turns off constant folding
+fold = not option('no-fold', False)
+# --no-infer turns off type inference, which swaps in unchecked instructions where it's safe
+infer = not option('no-infer', False)
+# --cache or --cache=<dir> saves the include expanded tokens of the source file so later runs can skip tokenizing and expanding
+cache = option('cache')
+# --stack-capacity=<n> sets the most values the stack can grow to hold
+stack_limit = option('stack-capacity', str(1 << 16))
+# --return-stack=<n> sets how many calls deep the vm can go, each call to a word or block takes one frame of the return stack
+return_limit = option('return-stack', str(1 << 16))
+# --flush=line or --flush=size picks when output is written, by default it's line for a terminal and size for pipes and files
+flush_rule = option('flush')
+# --image=<path> starts from the state saved in an image by save-image instead of from a fresh interpreter
+image = option('image')
+# --watch reruns the source file whenever it or anything it includes changes, only the changed files are tokenized again
+watch = option('watch', False)
+
 # if an argument was passed to the file
-if len(args := sys.argv[1:]) > 0:
+if len(args := [arg for arg in sys.argv[1:] if not arg.startswith('--')]) > 0:
     # get the argument
     filename = args[0]
     if filename.endswith('.xf'):
         if os.path.isfile(filename):
-            with open(filename, 'r') as f:
-                src = f.read()
+            # when streaming we'll open the file later on
+            if not stream:
+                with open(filename, 'r') as f:
+                    src = f.read()
             # now we'll add a location so we can know what file an error is coming from
             location = f'{filename}: '
         else:
@@ -50,9 +93,10 @@ class XForthException(Exception):
 # the ValueType object represents the datatype of a Forth value, for now we'll only have two:
 # Undefined and numbers
 # we'll use Python's enum class to construct it
+# it also inherits from int so that each type can be stored on the stack as a small integer
 from enum import Enum, auto
 
-class ValueType(Enum):
+class ValueType(int, Enum):
     Undefined = auto()
     Number = auto()
     Symbol = auto()
@@ -62,15 +106,31 @@ class ValueType(Enum):
     Address = auto()
     # our new string type
     String = auto()
+    # X-7 blocks, a list of tokens that can be called or used as data
+    Block = auto()
 
 # we'll use a dataclass for the value. We could (maybe should) just use tuples, but it will be nice to have named fields
 from dataclasses import dataclass
 from typing import Any
 
+# symbols are interned, the first time we see a symbol's name it gets the next id
+# ids are small ints that come out the same on every run, unlike hash() which Python randomizes for each process
+# symbol_ids maps names to ids and symbol_names is the reverse, the name of each id
+symbol_ids = {}
+symbol_names = []
+
+def intern_symbol(name: str) -> int:
+    '''intern_symbol returns the id of the symbol name, giving it a new one if it doesn't have one yet'''
+    symbol_id = symbol_ids.get(name)
+    if symbol_id is None:
+        symbol_id = symbol_ids[name] = len(symbol_names)
+        symbol_names.append(name)
+    return symbol_id
+
 # X-Forth Constants
 # we'll also create a constant for the value Undefined which is both the type and the constant
-# the value will just be the hash of Undefined:
-UNDEFINED = hash('Undefined:')    
+# the value will just be the id of Undefined:
+UNDEFINED = intern_symbol('Undefined:')
 # we can use these instead of the numbers themselves to avoid confusion
 TRUE = 0.0
 FALSE = 1.0
@@ -128,6 +188,32 @@ FUNC_TABLE = {
     'append': lambda: builtin_append(),
     'to-string': lambda: builtin_to_string(),
     'symbol-from-string': lambda: builtin_symbol_from_string(),
+    # program memory, the sized words read and write numbers at a byte address through one of the typed views of memory
+    'region': lambda: builtin_region(),
+    'c@': lambda: builtin_memory_read('c@', memory_u8),
+    'c!': lambda: builtin_memory_write('c!', memory_u8),
+    'w@': lambda: builtin_memory_read('w@', memory_u16),
+    'w!': lambda: builtin_memory_write('w!', memory_u16),
+    'i@': lambda: builtin_memory_read('i@', memory_i32),
+    'i!': lambda: builtin_memory_write('i!', memory_i32),
+    'f@': lambda: builtin_memory_read('f@', memory_f64),
+    'f!': lambda: builtin_memory_write('f!', memory_f64),
+    'save-image': lambda: builtin_save_image(),
+    # X-7 blocks
+    'call': lambda: builtin_call(),
+    'apply': lambda: builtin_apply(),
+    # X-8 and X-9
+    'if': lambda: builtin_if(),
+    'loop': lambda: builtin_loop(),
+    'get': lambda: builtin_get(),
+    'put': lambda: builtin_put(),
+    # numeric blocks
+    'map': lambda: builtin_map(),
+    'filter': lambda: builtin_filter(),
+    'reduce': lambda: builtin_reduce(),
+    'sum': lambda: builtin_sum(),
+    'min': lambda: builtin_extreme('min', min),
+    'max': lambda: builtin_extreme('max', max),
 }
 
 # we'll also combine the operators and function like words into a single list for easy lookup
@@ -145,131 +231,313 @@ RESERVED_WORDS = [
     'True:',
     'False:',
     'include:',
+    # the compiler decides what these mean before any variables exist, so they can't be variable names either
+    '!:',
+    '@:',
 ]
 
 
-# the size of the stack
-STACK_CAPACITY = 1024
-# generate STACK_CAPACITY values
-stack = [Value() for _ in range(STACK_CAPACITY)]
-# NOTE that the following will not give you what you want
-# stack = [Value()] * STACK_CAPACITY
-# this code will actually contain a list of the same instance of Value
-# but the code above will create a unique instance for each entry
+# the most values the stack can hold, anything that isn't a whole number is caught before we run
+STACK_CAPACITY = int(stack_limit) if str(stack_limit).isdigit() else 0
+# the stack starts out small and grows as it's needed, see stack_grow
+STACK_INITIAL_CAPACITY = 64
+# instead of a list of Value objects the stack is a struct of arrays, one array for the types and another for the values
+# stack_types stores each ValueType as a single byte and stack_values stores the values themselves
+# pushing is then two list writes rather than two attribute writes through a Value object, and a slot costs 9 bytes instead of a whole object
+from array import array
+stack_capacity = min(STACK_INITIAL_CAPACITY, STACK_CAPACITY)
+stack_types = array('B', [ValueType.Undefined]) * stack_capacity
+# unlike with Value objects, it's fine to repeat the same value since UNDEFINED is an int and can't be modified
+stack_values = [UNDEFINED] * stack_capacity
 stack_top = -1
 
+# the arrays give us the type back as a plain int
+# ValueType(tag) would convert it, but indexing a list is much faster
+VALUE_TYPES = [None, *ValueType]
+
+# the values of symbols and Undefined are symbol ids and the value of an address is an index into memory
+# they're all small ints that could be equal to a number, so == only compares values from the same domain
+# numbers, bools and strings are in domain 0, symbol ids in 1 and addresses in 2. The list is indexed by type tag like VALUE_TYPES
+EQUALITY_DOMAINS = [0, *(1 if t in (ValueType.Undefined, ValueType.Symbol) else 2 if t is ValueType.Address else 0 for t in ValueType)]
+
+def values_equal(a_type: ValueType, a: Any, b_type: ValueType, b: Any) -> bool:
+    '''values_equal implements ==, a symbol id or address is never equal to a number, bool or string even if they have the same value'''
+    return a == b and EQUALITY_DOMAINS[a_type] == EQUALITY_DOMAINS[b_type]
+
+
+# Variable Memory
+# variables live in one contiguous block of memory, like the Memory spec for X-4 in the README
+# each variable name is bound to a slot when it's compiled, and the variable's address is its index in memory, VAR_START + its slot
+# like the stack, memory is a struct of arrays, memory_types holds the types and memory_values holds the values
+MEMORY_CAPACITY = 1024
+# the start of variable memory, for now variables are the only thing in memory
+VAR_START = 0
+memory_types = array('B', [ValueType.Undefined]) * MEMORY_CAPACITY
+memory_values = [UNDEFINED] * MEMORY_CAPACITY
+
+# what each slot holds, a slot is free until var or con defines it
+SLOT_FREE = 0
+SLOT_VAR = 1
+SLOT_CON = 2
+slot_kinds = array('B')
+# maps the symbol id of a variable's name to its slot, slot_symbols is the reverse
+variable_slots = {}
+slot_symbols = []
+
+def variable_slot(symbol_id: int) -> int:
+    '''variable_slot returns the slot of the variable named by symbol_id, giving it the next slot if it doesn't have one yet'''
+    slot = variable_slots.get(symbol_id)
+    if slot is None:
+        slot = variable_slots[symbol_id] = len(slot_symbols)
+        slot_symbols.append(symbol_id)
+        slot_kinds.append(SLOT_FREE)
+        # when memory is full we double it, in place so anything holding on to the arrays still sees all of it
+        if VAR_START + slot == len(memory_values):
+            size = len(memory_values)
+            memory_types.extend(array('B', [ValueType.Undefined]) * size)
+            memory_values.extend([UNDEFINED] * size)
+    return slot
+
+# Program Memory
+# X-15 describes one contiguous memory split into regions for variables, keyboard input, screen pixels and a data section.
+# Variables can hold any X-Forth value, including strings, so they keep their tagged cells above.
+# Everything else is plain numbers, so it lives in a single preallocated bytearray that the sized words read and write through typed views
+# Each view is a cast of the same buffer, so anything that wants the raw bytes, like a screen, can share them without copying
+from typing import Dict, List, Tuple
 
-# a place to store variables
-# its a map of variable name symbol hashes to their Value
-variables = dict()
-
-# here we'll cache paths so we don't include them more than once
-included_paths = []
+@dataclass
+class Region:
+    '''Region describes a part of program memory, start and size are in bytes'''
+    name: str
+    start: int
+    size: int
+
+# the size of each region, a screen is one byte per pixel and 256x240 is the size the X-17 spec recommends
+INPUT_SIZE = 256
+SCREEN_WIDTH = 256
+SCREEN_HEIGHT = 240
+DATA_SIZE = 64 * 1024
+
+def layout_regions(sizes: List[Tuple[str, int]]) -> Dict[str, Region]:
+    '''layout_regions places regions one after another, each one starts on an 8 byte boundary so every view can reach all of it'''
+    regions = {}
+    start = 0
+    for name, size in sizes:
+        regions[name] = Region(name, start, size)
+        start += (size + 7) // 8 * 8
+    return regions
+
+MEMORY_REGIONS = layout_regions([
+    ('input', INPUT_SIZE),
+    ('screen', SCREEN_WIDTH * SCREEN_HEIGHT),
+    ('data', DATA_SIZE),
+])
+# the casts need a whole number of f64s
+MEMORY_SIZE = (max(region.start + region.size for region in MEMORY_REGIONS.values()) + 7) // 8 * 8
+
+memory = bytearray(MEMORY_SIZE)
+# the typed views, named after the words that use them
+memory_u8 = memoryview(memory)
+memory_u16 = memory_u8.cast('H')
+memory_i32 = memory_u8.cast('i')
+memory_f64 = memory_u8.cast('d')
+
+# here we'll cache the content hash of each file we've included, keyed on its real path, so we don't include them more than once
+included_paths = {}
+# and the hashes on their own, so a copy of a file we've already included under another path isn't included again
+included_digests = set()
 
 # let's create a global table of symbols to avoid recreating them over and over
-# it will be a table of hashes to symbol words so we can easily look up the word based on its hash
+# it will be a table of ids to symbol words for the symbols that have been used, symbol_names has every symbol we've interned
 symbols = {
     # first we'll add our constants,
-    hash('Undefined:') : 'Undefined:',
-    hash('True:') : 'True:',
-    hash('False:') : 'False:',
-    # Adding entries for each of the ValueTypes in the form: 'Type:' : hash('Type:')
-    **{ hash(sym) : sym for sym in [ t.name + ':' for t in ValueType ]},
+    UNDEFINED : 'Undefined:',
+    intern_symbol('True:') : 'True:',
+    intern_symbol('False:') : 'False:',
+    # Adding entries for each of the ValueTypes in the form: id : 'Type:'
+    **{ intern_symbol(sym) : sym for sym in [ t.name + ':' for t in ValueType ]},
 }
+# the symbol for each ValueType, indexed by its tag like VALUE_TYPES
+TYPE_SYMBOLS = [None, *(symbol_ids[t.name + ':'] for t in ValueType)]
 
 # a bit of extra documentation
 # adding the Tuple annotation 
-from typing import List, Tuple
+from typing import Callable, Iterable, Iterator, List, Tuple
 
-# this function prints the vars with their name instead of hash value
+# this function prints the vars with their name instead of their id
 # we'll expand on this in a later lesson before exposing this function to X-Forth as the word 'variables'
 from pprint import pprint
 def pretty_vars():
+    output.flush()
     print('\n** VARIABLES **\n')
-    # note that we don't print builtins
-    pprint({symbols[k][:-1]: v for k,v in variables.items() if not v.builtin}, width=1)
+    # we build a Value for each defined variable so they print the same as before variables lived in memory
+    pprint({
+        symbol_names[symbol_id][:-1]: Value(VALUE_TYPES[memory_types[VAR_START + slot]], memory_values[VAR_START + slot], slot_kinds[slot] == SLOT_CON)
+        for slot, symbol_id in enumerate(slot_symbols) if slot_kinds[slot] != SLOT_FREE
+    }, width=1)
+
+# these are the escape sequences we support inside of strings, mapped to the characters they stand for
+ESCAPES = {
+    'n': '\n', # newline
+    'r': '\r', # carriage return
+    't': '\t', # tab
+    '"': '"',  # double quote
+}
+# a backslash followed by one of our escape characters
+# we compile this once so decoding a string doesn't have to rebuild it every time
+import re
+ESCAPE_PATTERN = re.compile(r'\\([nrt"])')
+
+def decode_escapes(string: str) -> str:
+    '''decode_escapes replaces the escape sequences in string with their real characters in a single left to right pass'''
+    # most strings don't contain any escapes, so we can skip the regex entirely
+    if '\\' not in string:
+        return string
+    return ESCAPE_PATTERN.sub(lambda match: ESCAPES[match[1]], string)
+
+# scan_tokens does the real work for both tokenize and tokenize_stream
+def scan_tokens(src: str, tokens: List[str], location: str, final: bool = True) -> int:
+    '''scan_tokens appends the tokens found in src to tokens and returns the index it stopped scanning at
+
+    Rather than building each token one char at a time we jump straight to the next " with str.find and let
+    str.split handle everything between strings, so the source is only scanned once.
+    If final is False src is only a chunk of a larger source, so a token or string running into the end of src
+    may not be complete yet. It is left unscanned and the returned index points at its start'''
+    # the index we've tokenized up to
+    index = 0
+    length = len(src)
+    while index < length:
+        # x-forth strings begin with " (double quote)
+        quote = src.find('"', index)
+        # no more strings, everything left is plain tokens
+        if quote == -1:
+            # str.split is implemented in C and uses a lookup table for ASCII whitespace
+            pieces = src[index:].split()
+            # if the chunk doesn't end in whitespace the last token might continue in the next chunk
+            if not final and pieces and not src[-1].isspace():
+                tokens.extend(pieces[:-1])
+                return length - len(pieces[-1])
+            tokens.extend(pieces)
+            return length
+        # tokenize everything before the string
+        # this allows things like 10"hello" to be parsed correctly
+        tokens.extend(src[index:quote].split())
+        # now find the " that ends the string
+        search = quote + 1
+        while True:
+            end = src.find('"', search)
+            # we need to check if we reach the end of the file before finishing the string
+            if end == -1:
+                # the rest of the string may be in the next chunk
+                if not final:
+                    return quote
+                token = src[quote:length-1] or '"'
+                raise XForthException(f'{location}ERROR: Unterminated String, expected " to end string {token} but found end of file')
+            # if the last char wasn't a backslash the " ends the string
+            # note that for an empty string src[end-1] is the opening "
+            if src[end-1] != '\\':
+                break
+            # otherwise it was an escaped " so keep looking after it
+            search = end + 1
+        # we need to replace escaped characters with their real versions
+        # string tokens keep their leading and trailing "
+        tokens.append('"' + decode_escapes(src[quote+1:end]) + '"')
+        # continue after the ending "
+        index = end + 1
+    return length
 
 # we're adding a location to the tokenize function
 def tokenize(src: str, location: str) -> List[str]:
     '''tokenize breaks up a source string into a series of tokens, represented as a list of strings'''
     # remove leading and trailing whitespace
     src = src.strip()
+    # fast path, without any strings a token is just a run of non whitespace characters
+    if '"' not in src:
+        return src.split()
     # the list of tokens to return
     # in X-B a token is just a string and thus tokens is a list of strings
     tokens = []
-    # we will use this to build up tokens comprised of more than one char
-    token = ''
-
-    # first we'll change this to a while loop in order to gain more control over the loop
-    index = 0
-    while index < len(src):
-    # for index, char in enumerate(src):
-        # here we'll manually get the char
-        char = src[index]
-        # if we get a space we want to end the last token and add it to the token list
-        if char.isspace():
-            # only add the token if it isn't empty
-            if token != '':
-                # add the token to the list
-                tokens.append(token)
-            # reset the token to an empty string
-            token = ''
-        # x-forth strings begin with " (double quote)
-        elif char == '"':
-            # here we'll add the token if it is not empty
-            # this allows things like 10"hello" to be parsed correctly
-            if token != '':
-                tokens.append(token)
-                token = ''
-            # string tokens start with "
-            token += '"' 
-            # move passed the first "
-            index += 1
-            # get the next char
-            c = src[index]
-            # get everything until we find another "
-            # Let's modify this while loop slightly
-            # while c != '"':
-            while True:
-                # # if the last char wasn't a backspace and the current char is a " we should end the string
-                if c == '"' and token[-1] != '\\':
-                    break
-                # we need to check if we reach the end of the file before finishing the string
-                if index >= len(src) -1:
-                    raise XForthException(f'{location}ERROR: Unterminated String, expected " to end string {token} but found end of file')
-
-                # add the char to the token
-                token += c
-                # incrememnt the index
-                index += 1
-                # get the next char
-                c = src[index]
-            # add the ending "
-            token += '"'
-
-            # we need to replace escaped characters with their real versions
-            token = token.replace('\\n', '\n') # newline
-            token = token.replace('\\r', '\r') # carriage return
-            token = token.replace('\\t', '\t') # tab
-            token = token.replace('\\"', '"')  # double quote
-
-            tokens.append(token)
-            # reset the token
-            token = ''
-        else:
-            # append the character to the token string
-            token += char
-            # if we are at the end of the src we should add the token to the list
-            if index >= len(src)-1:
-                tokens.append(token)
-        # now we need to manually increment the index
-        index += 1
+    scan_tokens(src, tokens, location)
     return tokens
 
+# how many characters (or bytes) tokenize_stream reads at a time
+CHUNK_SIZE = 64 * 1024
+
+import io
+import codecs
+def tokenize_stream(source, location: str, chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    '''tokenize_stream lazily yields the tokens of source, which can be anything with a read(size) method such as an open file or an mmap.
+
+    Only a chunk of the source plus any token that crosses the chunk boundary is held in memory at once, so tokens can be
+    interpreted while the rest of the file is still being read'''
+    # binary sources (mmap or files opened with 'rb') are decoded as utf-8 with the same newline handling as open(path, 'r')
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+    # the unfinished token or string carried over from the last chunk
+    pending = ''
+    while True:
+        # if a single token is larger than a chunk we read at least as much again as we're holding
+        # so a huge string is rescanned a logarithmic rather than linear number of times
+        data = source.read(max(chunk_size, len(pending)))
+        at_end = not data
+        if not isinstance(data, str):
+            data = decoder.decode(data, final=at_end)
+        src = pending + data
+        tokens = []
+        if at_end:
+            # like tokenize we ignore trailing whitespace
+            scan_tokens(src.rstrip(), tokens, location)
+            yield from tokens
+            return
+        stop = scan_tokens(src, tokens, location, final=False)
+        yield from tokens
+        pending = src[stop:]
+
+import mmap
+def stream_file(path: str, location: str) -> Iterator[str]:
+    '''stream_file lazily yields the tokens of the file at path. The file is memory mapped so the OS pages it in as we tokenize rather than us reading it all up front'''
+    with open(path, 'rb') as xf_file:
+        # you can't mmap an empty file, but an empty file has no tokens anyway
+        if os.fstat(xf_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(xf_file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            yield from tokenize_stream(source, location)
+
+class ChunkReader:
+    '''ChunkReader reads a file a chunk at a time for tokenize_stream, opening it again for each chunk rather than keeping it open.
+    An include waiting for the files it included to finish holds no file open, so a deep chain of includes can't run out of file descriptors'''
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+
+    def read(self, size: int) -> bytes:
+        with open(self.path, 'rb') as xf_file:
+            xf_file.seek(self.offset)
+            data = xf_file.read(size)
+        self.offset += len(data)
+        return data
+
 def error_stack_underflow(word: str):
     '''Stack underflow happens when there aren't enough arguments for a word'''
     raise XForthException(f'{location}ERROR: {word} : Stack underflow')
 
+def stack_grow() -> int:
+    '''stack_grow is called by a push that moved stack_top past the end of the stack. It doubles the stack up to STACK_CAPACITY and returns the new capacity
+
+    The arrays are extended in place, so anything holding on to stack_types or stack_values still sees the whole stack'''
+    global stack_top, stack_capacity
+    # the vm keeps its own copy of the capacity which can be out of date if something else grew the stack
+    if stack_top < stack_capacity:
+        return stack_capacity
+    if stack_capacity >= STACK_CAPACITY:
+        # undo the push so the stack is left as it was
+        stack_top -= 1
+        raise XForthException(f'{location}ERROR: Stack overflow, the stack can only hold {STACK_CAPACITY} values, use --stack-capacity=<n> to raise the limit')
+    extra = min(max(stack_capacity, 1), STACK_CAPACITY - stack_capacity)
+    stack_types.extend(array('B', [ValueType.Undefined]) * extra)
+    stack_values.extend([UNDEFINED] * extra)
+    stack_capacity += extra
+    return stack_capacity
+
 # error helper for invalid stack types
 def error_stack_invalid_types(expected_types: List[ValueType], found_type: ValueType, index: int, word=None):
     '''This is raised when the stack desn't contain the expected types. Note that the word is an optional argument that can be used to give context on the word that errored'''
@@ -302,18 +570,18 @@ def stack_invalid_types(type_list: List[ValueType], raise_exception: bool = True
     type_i = 0
     # loop backwards through the stack, top to bottom
     for i in range(top, top - value_count,-1):
-        # get the value to check
-        value = stack[i]
+        # get the type of the value to check
+        value_type = VALUE_TYPES[stack_types[i]]
         # get the valid_type
         valid_type = type_list[type_i]
         # loop through valid types to check if the value's type is included
-        if value.type != valid_type and valid_type != ValueType.Any:
+        if value_type != valid_type and valid_type != ValueType.Any:
             if raise_exception:
                 # this calculates the index such that the top stack value is 0, the next is 1, etc
                 index  = type_i
-                error_stack_invalid_types([valid_type], value.type, index, word)
-                # raise XForthException(f'{location}ERROR: Invalid Stack, expected type(s): {valid_type} for stack value at index {i} but found {value.type.name}')
-            return (valid_type, value.type, i)
+                error_stack_invalid_types([valid_type], value_type, index, word)
+                # raise XForthException(f'{location}ERROR: Invalid Stack, expected type(s): {valid_type} for stack value at index {i} but found {value_type.name}')
+            return (valid_type, value_type, i)
         # increment type_i
         type_i += 1
     return ()
@@ -327,30 +595,71 @@ def stack_get_type():
     if stack_top < 0:
         # if there aren't enough arguments that is a stack underflow
         error_stack_underflow('type')
-    # get the value from the top of the stack
-    val = stack[stack_top]
-    # get the vals type name and convert it to a hash
-    type_symbol_hash = hash(val.type.name+':')
+    # get the symbol for the type of the value on the top of the stack
+    type_symbol_id = TYPE_SYMBOLS[stack_types[stack_top]]
     # we don't increment the stack because we're replacing the current value with its type
     # set the new value's type to a symbol
-    stack[stack_top].type = ValueType.Symbol
-    # get the symbol created from the type's name
-    stack[stack_top].value = type_symbol_hash
+    stack_types[stack_top] = ValueType.Symbol
+    # push the symbol for the type's name
+    stack_values[stack_top] = type_symbol_id
 
 # this is a helper for printing and display so we don't have to copy and paste back and forth between stack_print and stack_display
-def get_printed_value(value: ValueType) -> Any:
-    '''get_printed_value takes a value and returns its printable form'''
+def get_printed_value(value_type: ValueType, value: Any) -> Any:
+    '''get_printed_value takes a value and its type and returns its printable form'''
 
-    if value.type == ValueType.Symbol:
-        return symbols[value.value]
+    if value_type == ValueType.Symbol:
+        return symbol_names[value]
     # bools
-    elif value.type == ValueType.Bool:
-        return 'True' if value.value == 0 else 'False'
+    elif value_type == ValueType.Bool:
+        return 'True' if value == 0 else 'False'
     # undefined
-    elif value.type == ValueType.Undefined:
+    elif value_type == ValueType.Undefined:
         return 'Undefined'
     else:
-        return value.value
+        return value
+
+# Output
+# instead of calling print for every value, ., show and .s write to an output buffer which writes to sys.stdout in large chunks.
+# For a terminal we flush on each newline so output still shows up right away, for pipes and files we flush once OUTPUT_BUFFER_SIZE
+# characters have been collected, and whatever is left is flushed at exit.
+# Anything else that prints, like errors, must flush output first so everything comes out in order
+OUTPUT_BUFFER_SIZE = 64 * 1024
+from typing import Optional
+
+class Output:
+    '''Output collects text and writes it to sys.stdout in chunks'''
+    def __init__(self, flush_size: int = OUTPUT_BUFFER_SIZE, rule: Optional[str] = None):
+        self.parts = []
+        self.size = 0
+        self.flush_size = flush_size
+        # line or size, None picks one based on the stream
+        self.rule = rule
+        self.line_buffered = False
+        # the stream the buffered text is going to
+        self.stream = None
+
+    def write(self, text: str):
+        stream = sys.stdout
+        # print and redirect_stdout can change sys.stdout, what we've collected so far belongs to the old stream
+        if stream is not self.stream:
+            self.flush()
+            self.stream = stream
+            self.line_buffered = self.rule == 'line' if self.rule else stream.isatty()
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.flush_size or (self.line_buffered and '\n' in text):
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.stream.write(''.join(self.parts))
+            self.stream.flush()
+            self.parts.clear()
+            self.size = 0
+
+output = Output(rule=flush_rule)
+import atexit
+atexit.register(output.flush)
 
 # we'll use this to display what is currently on the stack
 def stack_display():
@@ -358,27 +667,27 @@ def stack_display():
     <count of values> val1 val2 ... ok'''
     # how many elements are on the stack
     count = stack_top + 1
-    # first we'll print the number of values on the stack
-    print(f'<{count}> ', end='')
+    # we build the whole line and write it once, first the number of values on the stack
+    parts = [f'<{count}>']
     # only try to print if there is at least 1 value on the stack
     if count >= 1:
         for i in range(count):
-            value = stack[i]
+            value_type = stack_types[i]
             # get the printable value
-            printed_value = get_printed_value(value)
+            printed_value = get_printed_value(value_type, stack_values[i])
             # for strings we want to include quotes for display
-            if value.type == ValueType.String:
+            if value_type == ValueType.String:
                 # to display we don't want to actually print newlines instead want to escape them
                 printed_value = printed_value.replace('\n', '\\n')
                 printed_value = printed_value.replace('\r', '\\r') # also do carriage return for good measure
                 printed_value = printed_value.replace('"', '\\"') # also we want quotes to be escaped
                 # we want to display the string with leading and trailing quotes
                 printed_value = '"' + printed_value + '"'
-                # append the string token
-            print(f'{printed_value} ', end='')
+            parts.append(str(printed_value))
 
     # Forth ends its stack display with ok, let's do this
-    print('ok')
+    parts.append('ok')
+    output.write(' '.join(parts) + '\n')
 
 def stack_drop():
     '''stack_drop removes an element from the top of the stack
@@ -398,13 +707,13 @@ def stack_dup():
     # we need at least 1 argument
     if stack_top < 0:
         error_stack_underflow('dup')
-    # get the current top value
-    val = stack[stack_top]
     # incrememnt the stack top
     stack_top += 1
-    # copy the values to the new value at the top of the stack
-    stack[stack_top].type = val.type
-    stack[stack_top].value = val.value
+    if stack_top == stack_capacity:
+        stack_grow()
+    # copy the type and value under it to the new top of the stack
+    stack_types[stack_top] = stack_types[stack_top-1]
+    stack_values[stack_top] = stack_values[stack_top-1]
 
 # by passing a bool to stack_print we can use it for both . and show
 def stack_print(consume: bool = True):
@@ -420,87 +729,396 @@ def stack_print(consume: bool = True):
         # if there aren't enough arguments that is a stack underflow
         error_stack_underflow('.')
     # get the value from the top of the stack
-    val = stack[stack_top]
+    value_type = stack_types[stack_top]
+    value = stack_values[stack_top]
     # if we should consume it, decrement the stack
     if consume:
         stack_top -= 1
 
     # print the value
-    printed_value = get_printed_value(val)
-
-    print(printed_value)
-
-# TODO need to create a lookup table to cache absolute paths to avoid reimporting them in circular includes
-# TODO make this function recursive
-def builtin_expand_includes(tokens: List[str], show_info=False) -> List[str]:
-    '''builtin_expand_includes includes external x-forth files.'''
-
-    # we'll push the tokens to this list
-    final_tokens = []
-
-    # we need the index
-    for i, token in enumerate(tokens):
-        if token == 'include' and i > 0:
-            if i < 1:
-                raise XForthException(f'{location}ERROR: include : Expected literal string argument but found none')
-            # get last token
-            last_token = tokens[i-1]
-            # check if it is a string
-            if last_token.startswith('"') and last_token.endswith('"'):
-                # have we included this path before?
-                # default true
-                path_included = True
-                # exclude the quotes from the path
-                xf_path = last_token[1:-1]
-                # some info to show how often include is called
-                if show_info:
-                    # there should be a green version of this for each include
-                    print(f'\x1b[92mEXPANDING INCLUDE {xf_path}...\x1b[0m')
-                # if it is a .xf path
-                if xf_path.endswith('.xf'):
-                    if os.path.isfile(xf_path):
-                        # convert to an absolute path
-                        xf_path = os.path.abspath(xf_path)
-                        if not xf_path in included_paths:
-                            # info to show how often include actually reads and expands files
-                            if show_info:
-                                # there should be one yellow version for each file, even if multiple differing relative paths are used
-                                # and even when it is included multiple times
-                                print(f'\x1b[93mEXPANDING TOKENS FOR {xf_path}\x1b[0m')
-                            # set path included to false
-                            path_included = False
-                            # open file and read source
-                            with open(xf_path, 'r') as xf_file:
-                                new_source = xf_file.read()
+    printed_value = get_printed_value(value_type, value)
+
+    output.write(f'{printed_value}\n')
+
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# when watching, the tokens of every file are kept between runs along with the file's stamp, so only files that changed are tokenized again
+# each entry is path : (stamp, digest, tokens), and watched_paths is every file the current run has read
+token_cache: Dict[str, Tuple[Tuple[int, int], str, List[str]]] = {}
+watched_paths = set()
+
+def file_stamp(xf_path: str) -> Optional[Tuple[int, int]]:
+    '''file_stamp returns the modification time and size of the file at xf_path, which change whenever it's written to, or None if it's gone'''
+    try:
+        stat = os.stat(xf_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def read_include(xf_path: str, location: Optional[str] = None) -> Tuple[str, List[str]]:
+    '''read_include returns the sha256 hash of the file at xf_path and its tokens.
+    It runs on include_pool so it must not touch any global state other than the watch cache, and a single dict or set operation is atomic'''
+    if watch:
+        watched_paths.add(xf_path)
+        # the stamp is taken before reading, so if the file changes while we read it the next poll still sees a change
+        stamp = file_stamp(xf_path)
+        cached = token_cache.get(xf_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+        # the file changed, if it no longer tokenizes it shouldn't look unchanged to the next poll
+        token_cache.pop(xf_path, None)
+    with open(xf_path, 'rb') as xf_file:
+        data = xf_file.read()
+    # same newline handling as open(path, 'r') and stream_file
+    src = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    digest, tokens = hashlib.sha256(data).hexdigest(), tokenize(src, location or xf_path)
+    if watch:
+        token_cache[xf_path] = (stamp, digest, tokens)
+    return digest, tokens
+
+def include_targets(tokens: List[str]) -> Iterator[str]:
+    '''include_targets yields the real path of each file tokens include. Anything that isn't a valid include is skipped, builtin_expand_includes reports it when it gets there'''
+    for index in range(1, len(tokens)):
+        if tokens[index] == 'include':
+            last_token = tokens[index-1]
+            if last_token.startswith('"') and last_token.endswith('"') and last_token.endswith('.xf"') and os.path.isfile(last_token[1:-1]):
+                yield os.path.realpath(last_token[1:-1])
+
+# the pool included files are read and tokenized on, it is only started the first time something is included
+include_pool: Optional[ThreadPoolExecutor] = None
+
+def resolve_includes(xf_path: str, reads: Dict[str, Future]):
+    '''resolve_includes reads and tokenizes xf_path and every file it includes, directly or through another include, in parallel on include_pool.
+
+    reads maps the real path of each file to the future of its read_include, a file already in it isn't read again.
+    resolve_includes returns once the whole include graph has been read, so the files can be spliced in declaration order'''
+    global include_pool
+    if include_pool is None:
+        include_pool = ThreadPoolExecutor(thread_name_prefix='include')
+    pending = set()
+    def submit(path: str):
+        if path not in reads:
+            reads[path] = include_pool.submit(read_include, path)
+            pending.add(reads[path])
+    submit(xf_path)
+    # as each file finishes we can look at its tokens and start reading the files it includes
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            # a file that failed to read has no includes to follow, the error is raised when the splice reaches it
+            if future.exception() is None:
+                for path in include_targets(future.result()[1]):
+                    submit(path)
+
+def builtin_expand_includes(tokens: Iterable[str], show_info=False) -> Iterator[str]:
+    '''builtin_expand_includes includes external x-forth files.
+
+    It is a generator so tokens can be streamed through it. When it reaches an include the whole graph of files below it is read and tokenized
+    up front by resolve_includes, then each file is spliced in where its include is, in declaration order. A file is only included once,
+    even when it is reached through a symlink or is a copy of a file we already included.
+    With --stream nothing is read up front, each file is hashed and then tokenized a chunk at a time as it's spliced in,
+    so only a chunk of each file we're in the middle of is held in memory.
+
+    Rather than calling itself for each include it keeps a worklist of the token streams it is in the middle of,
+    so deep include chains can't hit the recursion limit and tokens are passed along one at a time without copying any lists'''
+
+    # the reads of every file in the include graphs we've resolved so far
+    reads = {}
+
+    # the worklist, each entry is a stream of tokens along with the token before the current one and the token we're holding back.
+    # the innermost include is last and when a stream runs out we go back to the one that included it
+    # we hold back the last token until we know it isn't the path of an include
+    streams = [(iter(tokens), None, None)]
+
+    while streams:
+        tokens, last_token, held_token = streams.pop()
+        for token in tokens:
+            if token == 'include' and last_token is not None:
+                # check if it is a string
+                if last_token.startswith('"') and last_token.endswith('"'):
+                    # have we included this path before?
+                    # default true
+                    path_included = True
+                    # exclude the quotes from the path
+                    xf_path = last_token[1:-1]
+                    # some info to show how often include is called
+                    if show_info:
+                        # there should be a green version of this for each include
+                        print(f'\x1b[92mEXPANDING INCLUDE {xf_path}...\x1b[0m')
+                    # if it is a .xf path
+                    if xf_path.endswith('.xf'):
+                        if os.path.isfile(xf_path):
+                            # convert to a real path so symlinks to the same file are the same path
+                            xf_path = os.path.realpath(xf_path)
+                            if not xf_path in included_paths:
+                                # --watch keeps every file's tokens for the next run, so it reads them whole even when streaming
+                                if stream and not watch:
+                                    digest, file_tokens = file_digest(xf_path), None
+                                else:
+                                    if not xf_path in reads:
+                                        resolve_includes(xf_path, reads)
+                                    # this raises any error from reading or tokenizing the file
+                                    digest, file_tokens = reads[xf_path].result()
+                                # cache path so we don't include more than once, even if it turns out to be a copy
+                                included_paths[xf_path] = digest
+                                if not digest in included_digests:
+                                    # info to show how often include actually reads and expands files
+                                    if show_info:
+                                        # there should be one yellow version for each file, even if multiple differing relative paths are used
+                                        # and even when it is included multiple times
+                                        print(f'\x1b[93mEXPANDING TOKENS FOR {xf_path}\x1b[0m')
+                                    included_digests.add(digest)
+                                    # set path included to false
+                                    path_included = False
+                        else:
+                            raise XForthException(f'ERROR: {xf_path}: Source File Not Found')
                     else:
-                        raise XForthException(f'ERROR: {xf_path}: Source File Not Found')
+                        raise XForthException(f'{location}ERROR: include : path {xf_path} is not a .xf file')
+
+                    # remove the string path, it was held back so we just forget it
+                    held_token = None
+                    last_token = token
+
+                    # if we haven't included that file before
+                    if not path_included:
+                        # come back to this stream once the file is done, and splice in the file's tokens by expanding them next
+                        streams.append((tokens, last_token, held_token))
+                        streams.append((tokenize_stream(ChunkReader(xf_path), xf_path) if file_tokens is None else iter(file_tokens), None, None))
+                        break
+
+                # did not find expected string
                 else:
-                    raise XForthException(f'{location}ERROR: include : path {xf_path} is not a .xf file')
-
-                # remove string path from final_tokens
-                final_tokens.pop()
-                
-                # if we haven't included that path before
-                if not path_included:
-                    # cache path so we don't include more than once
-                    included_paths.append(xf_path)
-                    # get the tokens from the new_source
-                    new_tokens = tokenize(new_source, xf_path)
-                    # recursively expand includes
-                    new_tokens = builtin_expand_includes(new_tokens, show_info)
-                    # add the tokens to the final tokens
-                    final_tokens.extend(new_tokens)
-
-            # did not find expected string
+                    raise XForthException(f'{location}ERROR: include : Expected literal string argument but found token {last_token}')
+
+            # pass other tokens along
             else:
-                raise XForthException(f'{location}ERROR: include : Expected literal string argument but found token {last_token}')
+                if held_token is not None:
+                    yield held_token
+                held_token = last_token = token
 
-        # append other tokens to final_tokens
+        # the stream ran out rather than reaching an include
         else:
-            final_tokens.append(token)
+            if held_token is not None:
+                yield held_token
+
+# bump this whenever a change to the tokenizer or includes would change the tokens in the cache, or the state saved in an image changes
+XFORTH_VERSION = '15.5'
+# the directory the cache is saved to when --cache is passed without a directory, like Python's __pycache__
+CACHE_DIR = '__xfcache__'
+
+import marshal
+
+def file_digest(path: str) -> str:
+    '''file_digest returns the sha256 hash of a file's contents, reading it a chunk at a time'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as xf_file:
+        while chunk := xf_file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(filename: str, src: str, cache_dir: str) -> str:
+    '''cache_path returns the path of the cache entry for src. The entry is keyed on the content of src and the interpreter version.
+    The working directory is part of the key too, because include paths are relative to it, and so are the files that have already been
+    included, like those of an --image, because expanding src skips them'''
+    key = hashlib.sha256()
+    # the marshal format can change between Python versions so the cache_tag (ex. cpython-311) is part of the version
+    for part in (XFORTH_VERSION, sys.implementation.cache_tag, os.getcwd(), repr(sorted(included_paths.items())), src):
+        key.update(part.encode())
+        # separate the parts so they can't run together
+        key.update(b'\0')
+    return os.path.join(cache_dir, f'{os.path.basename(filename)}.{key.hexdigest()[:32]}.xfc')
+
+def load_cached_tokens(path: str) -> Optional[List[str]]:
+    '''load_cached_tokens returns the tokens saved at path or None if there is no entry or one of the files it included has changed'''
+    try:
+        with open(path, 'rb') as cache_file:
+            dependencies, tokens = marshal.load(cache_file)
+        # every included file must still have the same content
+        for xf_path, digest in dependencies:
+            if file_digest(xf_path) != digest:
+                return None
+    # a missing or corrupt entry is just a cache miss
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    # the includes were already expanded into tokens, so we still have to remember that we've included them
+    for xf_path, digest in dependencies:
+        included_paths[xf_path] = digest
+        included_digests.add(digest)
+    return tokens
 
+def save_cached_tokens(path: str, tokens: List[str], dependencies: List[Tuple[str, str]]):
+    '''save_cached_tokens saves tokens to path along with the (path, content hash) of each of the files they included'''
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so another run never sees a half written entry
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as cache_file:
+            marshal.dump((dependencies, tokens), cache_file)
+        os.replace(temp_path, path)
+    # failing to save the cache shouldn't stop the program, it'll just be slower next time
+    except OSError:
+        pass
+
+def expand_source(filename: str, src: str, location: str, cache_dir: str) -> List[str]:
+    '''expand_source returns the include expanded tokens of src. If the cache in cache_dir has an entry for src, and nothing it includes has changed,
+    the tokens are loaded from it and tokenize and builtin_expand_includes are skipped entirely'''
+    path = cache_path(filename, src, cache_dir)
+    tokens = load_cached_tokens(path)
+    if tokens is None:
+        # any path added to included_paths while expanding was included by this source, the dict keeps them in the order they were added
+        first_include = len(included_paths)
+        tokens = list(builtin_expand_includes(tokenize(src, location)))
+        save_cached_tokens(path, tokens, list(included_paths.items())[first_include:])
+    return tokens
+
+# Images
+# an image is a snapshot of everything a program has defined, like the image of a classic Forth.
+# a prelude can be run once and end with "prelude.img" save-image, then later runs start from --image=prelude.img
+# with all of its symbols, variables, constants and program memory already in place, without including or running any of it again.
+# symbol ids and slots are handed out densely and restored as they were, so anything compiled against them means the same thing after loading.
+# the stack is not part of the image, just like a Forth image only holds the dictionary
+import zlib
 
-    return final_tokens
+# every image starts with this so we can tell an image from any other file
+IMAGE_MAGIC = b'XFIMG'
+
+def builtin_save_image():
+    '''builtin_save_image saves the interpreter's state to an image at the path on the top of the stack: ( string -- )'''
+    global stack_top
+    word = 'save-image'
+    if stack_top < 0:
+        error_stack_underflow(word)
+    stack_invalid_types([ValueType.String], word=word)
+    path = stack_values[stack_top]
+    # like the cache, an image is only valid for the interpreter and Python that saved it
+    image_data = (XFORTH_VERSION, sys.implementation.cache_tag, save_state())
+    try:
+        # memory is mostly zeros so it compresses very well
+        with open(path, 'wb') as image_file:
+            image_file.write(IMAGE_MAGIC + zlib.compress(marshal.dumps(image_data)))
+    except OSError as e:
+        raise XForthException(f'{location}ERROR: {word} : Could not write image {path}, {e.strerror}')
+    stack_top -= 1
+
+def load_image(path: str):
+    '''load_image restores the state saved to the image at path by save-image.
+    Names are bound to slots when they're compiled, so it has to run before anything is compiled'''
+    try:
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+        if not data.startswith(IMAGE_MAGIC):
+            raise ValueError(path)
+        version, cache_tag, state = marshal.loads(zlib.decompress(data[len(IMAGE_MAGIC):]))
+    except OSError:
+        raise XForthException(f'ERROR: {path}: Image Not Found')
+    except (EOFError, ValueError, TypeError, zlib.error):
+        raise XForthException(f'ERROR: {path}: Invalid image')
+    if (version, cache_tag) != (XFORTH_VERSION, sys.implementation.cache_tag):
+        raise XForthException(f'ERROR: {path}: Image was saved by X-Forth {version} on {cache_tag}, run the prelude and save it again')
+    restore_state(state)
+
+def save_state() -> tuple:
+    '''save_state returns a copy of everything the program has defined, as plain values that marshal can save'''
+    # marshal can't save a Block, so each block is saved once in a table and memory and other blocks refer to it by its index.
+    # Blocks compare by identity, so two values that were the same block have to be the same block again after a restore
+    blocks = []
+    indices = {}
+    def save_block(block: Block) -> int:
+        if id(block) not in indices:
+            # the index is taken before saving the tokens, so a block that holds itself refers to its own index
+            index = indices[id(block)] = len(blocks)
+            blocks.append(None)
+            # a block of numbers is saved as the bytes of its array, any other block as the text of its tokens, with nested blocks as (index, text)
+            blocks[index] = block.numbers.tobytes() if block.tokens is None else [
+                (save_block(token.value), token.text) if token.type is TokenType.Block else token.text for token in block.tokens ]
+        return indices[id(block)]
+    values = [ save_block(value) if value_type == ValueType.Block else value for value_type, value in zip(memory_types, memory_values) ]
+    return (
+        list(symbol_names), list(symbols),
+        list(slot_symbols), slot_kinds.tobytes(), memory_types.tobytes(), values, blocks,
+        bytes(memory),
+        # the files that have already been included so including them again is still a no-op
+        list(included_paths.items()),
+    )
+
+def restore_state(state: tuple):
+    '''restore_state puts back the state returned by save_state, replacing whatever has been defined since'''
+    names, used_symbols, slots, kinds, types, values, saved_blocks, program_memory, includes = state
+    # everything is restored in place, the engines and the typed views of memory hold on to these objects
+    symbol_names[:] = names
+    symbol_ids.clear()
+    symbol_ids.update((name, symbol_id) for symbol_id, name in enumerate(names))
+    symbols.clear()
+    symbols.update((symbol_id, names[symbol_id]) for symbol_id in used_symbols)
+    slot_symbols[:] = slots
+    variable_slots.clear()
+    variable_slots.update((symbol_id, slot) for slot, symbol_id in enumerate(slots))
+    slot_kinds[:] = array('B', kinds)
+    memory_types[:] = array('B', types)
+    # every block is made before any are filled in, so blocks can hold each other
+    blocks = [ Block(None) for _ in saved_blocks ]
+    for block, saved in zip(blocks, saved_blocks):
+        if isinstance(saved, bytes):
+            block.numbers = array('d')
+            block.numbers.frombytes(saved)
+        else:
+            # the names in a block's tokens are bound to the slots we just restored
+            block.tokens = [ Token(TokenType.Block, blocks[item[0]], item[1]) if isinstance(item, tuple) else compile_token(item) for item in saved ]
+    memory_values[:] = [ blocks[value] if value_type == ValueType.Block else value for value_type, value in zip(memory_types, values) ]
+    # memory has views on it so it can't change size, it's always MEMORY_SIZE anyway
+    memory[:] = program_memory
+    included_paths.clear()
+    included_digests.clear()
+    for xf_path, digest in includes:
+        included_paths[xf_path] = digest
+        included_digests.add(digest)
+
+# Watch Mode
+import time
+
+# how often --watch checks the files for changes, in seconds. Comparing stamps is cheap so we poll rather than needing a file watching library
+WATCH_INTERVAL = 0.25
+
+def watch_source(filename: str, execute: Callable):
+    '''watch_source runs filename with execute, then runs it again every time it or a file it included changes, until it's interrupted.
+
+    Each run starts from the state we had before the first, so the last run's definitions aren't redefinitions.
+    The tokens of each file are kept in token_cache, so a run only tokenizes the files that changed'''
+    global stack_top
+    xf_path = os.path.realpath(filename)
+    start = save_state()
+    try:
+        while True:
+            restore_state(start)
+            stack_top = -1
+            # an error can leave the calls it happened in on the return stack
+            return_stack.clear()
+            watched_paths.clear()
+            # the source file is always watched, even if it couldn't be read
+            watched_paths.add(xf_path)
+            try:
+                if not os.path.isfile(xf_path):
+                    token_cache.pop(xf_path, None)
+                    raise XForthException(f'ERROR: {filename}: Source File Not Found')
+                _, tokens = read_include(xf_path, location)
+                execute(compile_tokens(builtin_expand_includes(tokens)))
+            # an error ends the run but we keep watching so it can be fixed
+            except XForthException as e:
+                output.flush()
+                print(e)
+            output.flush()
+
+            # compare against the stamps the files had when they were read, so a change made during the run isn't missed
+            stamps = { path: token_cache[path][0] if path in token_cache else file_stamp(path) for path in watched_paths }
+            changed = []
+            while not changed:
+                time.sleep(WATCH_INTERVAL)
+                changed = [ path for path, stamp in stamps.items() if file_stamp(path) != stamp ]
+            print(f'** CHANGED {", ".join(changed)} **')
+    # ctrl-c is how you stop watching
+    except KeyboardInterrupt:
+        output.flush()
 
 # TODO load
 # this needs to be above interpret because the interpreter needs to call it
@@ -545,24 +1163,284 @@ def is_number(src: str) -> bool:
     except:
         return None
 
-def interpret(tokens: List[str]):
-    '''interpret interates and executes the tokens passed to it'''
+# these words are shared by all of our execution engines
+def builtin_define(token: str):
+    '''builtin_define implements var and con, token is the word being run, either var or con'''
+    global stack_top
+    # check for stack underflow
+    # var needs at least 1
+    if token == 'var' and stack_top < 0:
+        error_stack_underflow(token)
+    # con always needs 2
+    if token == 'con' and stack_top < 1:
+        error_stack_underflow(token)
+
+    # validate that we have a value and a symbol
+    # note that we don't want an exception raised because we need to check for vars overload
+    value_symbol_sig = stack_invalid_types([ValueType.Any, ValueType.Symbol], raise_exception=False,word=token)
+    symbol_sig = stack_invalid_types([ValueType.Symbol], raise_exception=False,word=token)
+    # default value to Undefined
+    value_type = ValueType.Undefined
+    value = UNDEFINED
+    # check which signature we've found
+    if value_symbol_sig == ():
+        # get the value
+        value_type = VALUE_TYPES[stack_types[stack_top]]
+        value = stack_values[stack_top]
+        stack_top -= 1
+    elif symbol_sig == ():
+        # con requires a value
+        if token == 'con':
+            #raise XForthException(f'{location}ERROR: con : Invalid Stack, expected a value of any type  at 0 and Symbol: at 1 but found {found} at {i}')
+            raise XForthException(f'{location}ERROR: con : Invalid Stack, expected a value of any type  at 0 and Symbol: at 1 but found only a Symbol: at 0, constants must be initialized with a value')
+    # there was no valid sig
+    else:
+        _, found, i = value_symbol_sig if value_symbol_sig != () else symbol_sig
+        if token == 'var':
+            msg = f'{location}ERRROR: var : Invalid Stack, expected either any value at 0 and Symbol: at 1 or a Symbol: at 0 but found {found} at {i}'
+        else:
+            msg = f'{location}ERRROR: con : Invalid Stack, expected either any value at 0 and Symbol: at 1 but found {found} at {i}'
+        raise XForthException(msg)
+
+    # get the symbol
+    symbol = stack_values[stack_top]
+    slot = variable_slot(symbol)
+    # cannot redeclare constant that alread exists
+    if slot_kinds[slot] != SLOT_FREE and token == 'con':
+        raise XForthException(f'{location}ERROR: con: Constant Redefinition, you cannot redeclare constant {symbol_names[symbol][:-1]}')
+    # and a constant can't be turned back into a variable, constants never change so the compiler can replace them with their value
+    elif slot_kinds[slot] == SLOT_CON:
+        raise XForthException(f'{location}ERROR: var: Constant Redefinition, you cannot redeclare constant {symbol_names[symbol][:-1]}')
+    # you also cannot redeclare anything in RESERVED_WORDS
+    elif symbol_names[symbol] in RESERVED_WORDS:
+        raise XForthException(f'{location}ERROR: Constant Redefinition, you cannot redeclare constant {symbol_names[symbol][:-1]}')
+    # decrement stack
+    stack_top -= 1
+
+    # save the variable in its slot, its value is Undefined if no value was given
+    memory_types[VAR_START + slot] = value_type
+    memory_values[VAR_START + slot] = value
+    # mark the slot as a constant if we found con
+    slot_kinds[slot] = SLOT_CON if token == 'con' else SLOT_VAR
+
+def builtin_write():
+    '''builtin_write implements ! which writes the value on the top of the stack to the address under it'''
+    global stack_top
+    # ! requires two arguments
+    if stack_top < 1:
+        error_stack_underflow('!')
+
+    stack_invalid_types([ValueType.Any, ValueType.Address], word='!')
+
+    # get value
+    value_type = stack_types[stack_top]
+    value = stack_values[stack_top]
+    stack_top -= 1
+
+    # get address
+    addr = stack_values[stack_top]
+    stack_top -= 1
+
+    # write the type and value to memory
+    memory_types[addr] = value_type
+    memory_values[addr] = value
+
+def builtin_read():
+    '''builtin_read implements @ which replaces the address on the top of the stack with the value at that address'''
+    # ! requires one argument
+    if stack_top < 0:
+        error_stack_underflow('@')
+
+    stack_invalid_types([ValueType.Address], word='@')
+
+    # get address
+    addr = stack_values[stack_top]
+    # don't modify stack top since we'll be pushing again anyway
+    # stack_top -= 1
+    # stack_top += 1
+    # write the type and value in memory to the stack
+    stack_types[stack_top] = memory_types[addr]
+    stack_values[stack_top] = memory_values[addr]
+
+def error_undefined_token(token: str):
+    '''error_undefined_token is raised when a token is neither a word nor a defined variable'''
+    # suggest what the dev might have meant
+    suggestion = ''
+    # we'll check if a symbol exists and suggest that to the user in case they meant to type it
+    if symbol_ids.get(token + ':') in symbols:
+        suggestion = f', did you mean the Symbol {token+":"} ? If so you forgot the ending ":" (colon)'
+    raise XForthException(f'{location}ERROR: Undefined token {token}{suggestion}')
+
+
+# the kinds of compiled tokens
+class TokenType(Enum):
+    Number = auto()
+    String = auto()
+    Symbol = auto()
+    Bool = auto()
+    Undefined = auto()
+    Operator = auto()
+    # words from FUNC_TABLE
+    Function = auto()
+    Var = auto()
+    Con = auto()
+    Read = auto()
+    Write = auto()
+    # anything else should be the name of a variable, but we can't know until we run it
+    Name = auto()
+    # a block literal, [ ... ]
+    Block = auto()
+    # [ ... ] [ ... ] if and [ ... ] loop, made by lower_control_flow so the engines can run the blocks without pushing and calling them
+    If = auto()
+    Loop = auto()
+
+# this time we will use a tuple, a NamedTuple still gives us named fields but can also be unpacked quickly in a for loop
+from typing import NamedTuple
+
+class Token(NamedTuple):
+    '''Token is a token that has already been classified by compile_token, so the interpreter never has to look at its text again'''
+    type: TokenType
+    # the number for numbers, the string without quotes for strings, the symbol id for symbols, the slot for names
+    # the function to call for function words, TRUE or FALSE for bools and the Block for block literals
+    value: Any
+    # the original text of the token, used for errors and for operators
+    text: str
+
+def compile_token(token: str) -> Token:
+    '''compile_token classifies a single token string and parses its value'''
+    # numbers
+    if (number := is_number(token)) != None:
+        return Token(TokenType.Number, number, token)
+    # operators
+    elif token in OPERATORS:
+        return Token(TokenType.Operator, token, token)
+    # function words
+    elif token in FUNC_TABLE:
+        return Token(TokenType.Function, FUNC_TABLE[token], token)
+    # symbols
+    elif token.endswith(':'):
+        return Token(TokenType.Symbol, intern_symbol(token), token)
+    # bools
+    elif token == 'True' or token == 'False':
+        # note that we still use numeric values
+        return Token(TokenType.Bool, TRUE if token == 'True' else FALSE, token)
+    elif token == 'var':
+        return Token(TokenType.Var, None, token)
+    elif token == 'con':
+        return Token(TokenType.Con, None, token)
+    elif token == 'Undefined':
+        return Token(TokenType.Undefined, UNDEFINED, token)
+    elif token == '!':
+        return Token(TokenType.Write, None, token)
+    elif token == '@':
+        return Token(TokenType.Read, None, token)
+    # strings
+    elif token.startswith('"') and token.endswith('"'):
+        # save the string without its leading and trailing "
+        return Token(TokenType.String, token[1:-1], token)
+    # variables, note we bind the name to the slot of its symbol, the token + ':'
+    else:
+        return Token(TokenType.Name, variable_slot(intern_symbol(token+':')), token)
+
+# Blocks
+# a block literal is compiled into a single Token holding a Block. Its tokens are classified once, when compile_tokens reaches the literal,
+# and each engine compiles them into its own code the first time the block is called. That code is kept on the Block,
+# so calling a block again, or using the name of a constant holding one, doesn't look at a single token's text.
+# A block of only numbers, like [ 1 2 3 ], is a list of data far more often than it is code, so it is stored packed in an array('d')
+# instead of as tokens, which is 8 bytes a number rather than a tuple and a float object each
+@dataclass(eq=False)
+class Block:
+    '''Block is the value of an X-7 block. Blocks are compared by identity, like variables two blocks are only equal if they are the same block'''
+    # the compiled tokens between [ and ], None for a block of numbers, use block_tokens to get the tokens of any block
+    tokens: Optional[List[Token]]
+    # the block as it was written, used to print it. None until it's printed for blocks made by words like map
+    text: Optional[str] = None
+    # the numbers of a block of numbers
+    numbers: Optional[array] = None
+    # the code for the threaded engine and the vm, made the first time the block is called with that engine
+    threaded: Optional[list] = None
+    program: Optional[Any] = None
+    # the vm's code for [ ... ] loop with this block, made the first time the vm is given the block to loop from the stack
+    looped: Optional[Any] = None
+    # when the block is used as a table this maps each key to the position of its value in tokens, made by the first get
+    index: Optional[dict] = None
+    # what map, filter and reduce compile the block to when it's simple arithmetic, False if it isn't, made the first time they're given the block
+    kernel: Any = None
+
+    def __str__(self) -> str:
+        if self.text is None:
+            self.text = ' '.join(['[', *(t.text for t in block_tokens(self)), ']'])
+        return self.text
+
+    # the repr is different for every block so the constant pool never merges two blocks that happen to look the same
+    def __repr__(self) -> str:
+        return f'<Block {self} at {id(self):#x}>'
+
+def number_text(number: float) -> str:
+    '''number_text returns number the way it would be written in a block literal, so a whole number is 10 rather than 10.0'''
+    # very large whole numbers keep the float form rather than printing every digit
+    return str(int(number)) if number.is_integer() and abs(number) < 1e16 else repr(number)
+
+def block_tokens(block: Block) -> List[Token]:
+    '''block_tokens returns the tokens of block, a block of numbers makes them from its numbers'''
+    if block.tokens is None:
+        return [ Token(TokenType.Number, number, number_text(number)) for number in block.numbers ]
+    return block.tokens
+
+def block_length(block: Block) -> int:
+    '''block_length returns the number of tokens in block'''
+    return len(block.numbers) if block.tokens is None else len(block.tokens)
+
+def compile_block(tokens: Iterator[str]) -> Token:
+    '''compile_block compiles a block literal, the [ has already been taken from tokens and the block ends at its matching ]'''
+    body = []
+    for token in tokens:
+        if token == ']':
+            text = ' '.join(['[', *(t.text for t in body), ']'])
+            if body and all(t.type is TokenType.Number for t in body):
+                block = Block(None, text, numbers=array('d', (t.value for t in body)))
+            else:
+                block = Block(body, text)
+            return Token(TokenType.Block, block, text)
+        # blocks can be nested
+        elif token == '[':
+            body.append(compile_block(tokens))
+        else:
+            body.append(compile_token(token))
+    raise XForthException(f'{location}ERROR: [ : Unterminated block, expected ] to end the block but found end of file')
+
+def compile_tokens(tokens: Iterable[str]) -> Iterator[Token]:
+    '''compile_tokens lazily compiles each token in tokens, use list(compile_tokens(tokens)) to keep the compiled tokens around'''
+    # blocks take the tokens up to their ] from the same iterator
+    tokens = iter(tokens)
+    for token in tokens:
+        if token == '[':
+            yield compile_block(tokens)
+        elif token == ']':
+            raise XForthException(f'{location}ERROR: ] : Unexpected ], there is no block to end')
+        else:
+            yield compile_token(token)
+
+def interpret(tokens: Iterable[Token]):
+    '''interpret interates and executes the compiled tokens passed to it. tokens can be any iterable, including a lazy compile_tokens generator'''
     # declare global access to stack_top
     global stack_top
 
     # iterate through each token
-    for token in tokens:
+    for kind, value, token in tokens:
         # numbers
-        if (number := is_number(token)) != None:
+        if kind is TokenType.Number:
             # increment stack top
             stack_top += 1 
+            if stack_top == stack_capacity:
+                stack_grow()
             # set the type to number
-            stack[stack_top].type = ValueType.Number
+            stack_types[stack_top] = ValueType.Number
             # assign the value
-            stack[stack_top].value = number
+            stack_values[stack_top] = value
         # operators
-        elif token in WORDS:
-            if token in OPERATORS:
+        elif kind is TokenType.Operator or kind is TokenType.Function:
+            if kind is TokenType.Operator:
                 # all current operators require 2 arguments so we can check if the stack top is < 1
                 # if stack top is >= 1 there are 2 or more arguments on the stack
                 if stack_top < 1:
@@ -573,11 +1451,11 @@ def interpret(tokens: List[str]):
                 # [ 2 3 ]
                 # b = 3
                 # a = 2
-                b = stack[stack_top]
+                b = stack_values[stack_top]
                 # decrement the stack_top to pop the value
                 stack_top -= 1
                 # decrement the stack_top to pop the value
-                a = stack[stack_top]
+                a = stack_values[stack_top]
                 stack_top -= 1
 
                 result = None
@@ -590,17 +1468,17 @@ def interpret(tokens: List[str]):
                     # note that we pass stack_top+2 as the top becaues we've already popped the two arguments off the stack
                     stack_invalid_types([ValueType.Number, ValueType.Number], top=stack_top+2, word=token)
                     if token == '+':
-                        result = a.value + b.value
+                        result = a + b
                     elif token == '-':
-                        result = a.value - b.value
+                        result = a - b
                     elif token == '*':
-                        result = a.value * b.value
+                        result = a * b
                     elif token == '/':
                         # for now if we try to divide by zero we'll just get zero
-                        if b.value == 0:
+                        if b == 0:
                             result = 0.0
                         else:
-                            result = a.value / b.value
+                            result = a / b
                     result_type = ValueType.Number
                 if token in LOGIC_OPERATORS:
                     # boolean operators
@@ -609,189 +1487,1329 @@ def interpret(tokens: List[str]):
                     # Here will will start using True and False instead of 0 and 1
                     if token == '<':
                         stack_invalid_types([ValueType.Number, ValueType.Number], top=stack_top+2, word=token)
-                        result = TRUE if a.value < b.value else FALSE
+                        result = TRUE if a < b else FALSE
                     elif token == '>':
                         stack_invalid_types([ValueType.Number, ValueType.Number], top=stack_top+2, word=token)
-                        result = TRUE if a.value > b.value else FALSE
+                        result = TRUE if a > b else FALSE
                     # we don't check invalid stack for equality because you should be able to compare any types for equality
                     elif token == '==':
-                        result = TRUE if a.value == b.value else FALSE
+                        result = TRUE if values_equal(stack_types[stack_top+1], a, stack_types[stack_top+2], b) else FALSE
                     elif token == '!=':
-                        result = TRUE if a.value != b.value else FALSE
+                        result = FALSE if values_equal(stack_types[stack_top+1], a, stack_types[stack_top+2], b) else TRUE
                     result_type = ValueType.Bool
 
             # push the value back onto the stack 
             # first increment stack_top
                 stack_top += 1
                 # assign the result to the value
-                stack[stack_top].value = result
+                stack_values[stack_top] = result
                 # use the result_type value since it changes now
-                stack[stack_top].type = result_type
+                stack_types[stack_top] = result_type
             # function words
             else:
-                # lookup and call the function from FUNC_TABLE
-                FUNC_TABLE[token]()
+                # call the function compile_token looked up from FUNC_TABLE
+                value()
         # symbols
-        elif token.endswith(':'):
+        elif kind is TokenType.Symbol:
              # increment stack top
             stack_top += 1 
+            if stack_top == stack_capacity:
+                stack_grow()
             # set the type
-            stack[stack_top].type = ValueType.Symbol 
-            # create the symbol hash
-            symbol_hash = hash(token)
+            stack_types[stack_top] = ValueType.Symbol 
             # if its not in the symbols dict we should add it
-            if not symbol_hash in symbols.keys():
-                symbols[symbol_hash] = token
-            # set the value to the hash of the symbol's token
-            stack[stack_top].value = symbol_hash
+            if not value in symbols:
+                symbols[value] = token
+            # set the value to the id of the symbol's token
+            stack_values[stack_top] = value
         # bools
-        elif token == 'True' or token == 'False':
+        elif kind is TokenType.Bool:
             # increment stack top
             stack_top += 1 
+            if stack_top == stack_capacity:
+                stack_grow()
             # set the type to bool
-            stack[stack_top].type = ValueType.Bool
-            # assign the value, note that we still use numeric values
-            stack[stack_top].value = TRUE if token == 'True' else FALSE
+            stack_types[stack_top] = ValueType.Bool
+            # assign the value
+            stack_values[stack_top] = value
         # var and con
-        elif token == 'var' or token == 'con':
-            # check for stack underflow
-            # var needs at least 1
-            if token == 'var' and stack_top < 0:
-                error_stack_underflow(token)
-            # con always needs 2
-            if token == 'con' and stack_top < 1:
-                error_stack_underflow(token)
-
-            # validate that we have a value and a symbol
-            # note that we don't want an exception raised because we need to check for vars overload
-            value_symbol_sig = stack_invalid_types([ValueType.Any, ValueType.Symbol], raise_exception=False,word=token)
-            symbol_sig = stack_invalid_types([ValueType.Symbol], raise_exception=False,word=token)
-            # default value to Undefined
-            value = UNDEFINED
-            # check which signature we've found
-            if value_symbol_sig == ():
-                # get the value
-                value = stack[stack_top]
-                stack_top -= 1
-            elif symbol_sig == ():
-                # con requires a value
-                if token == 'con':
-                    #raise XForthException(f'{location}ERROR: con : Invalid Stack, expected a value of any type  at 0 and Symbol: at 1 but found {found} at {i}')
-                    raise XForthException(f'{location}ERROR: con : Invalid Stack, expected a value of any type  at 0 and Symbol: at 1 but found only a Symbol: at 0, constants must be initialized with a value')
-            # there was no valid sig
-            else:
-                _, found, i = value_symbol_sig if value_symbol_sig != () else symbol_sig
-                if token == 'var':
-                    msg = f'{location}ERRROR: var : Invalid Stack, expected either any value at 0 and Symbol: at 1 or a Symbol: at 0 but found {found} at {i}'
-                else:
-                    msg = f'{location}ERRROR: con : Invalid Stack, expected either any value at 0 and Symbol: at 1 but found {found} at {i}'
-                raise XForthException(msg)
-
-            # get the symbol
-            symbol = stack[stack_top]
-            # cannot redeclare constant that alread exists
-            if symbol.value in variables.keys() and token == 'con':
-                raise XForthException(f'{location}ERROR: con: Constant Redefinition, you cannot redeclare constant {symbols[symbol.value][:-1]}')
-            # you also cannot redeclare anything in RESERVED_WORDS
-            elif symbols[symbol.value] in RESERVED_WORDS:
-                raise XForthException(f'{location}ERROR: Constant Redefinition, you cannot redeclare constant {symbols[symbol.value][:-1]}')
-            # decrement stack
-            stack_top -= 1
-            
-            # save the variable
-            v = Value()
-            # assign the value if it exists
-            if value != UNDEFINED:
-                v.type = value.type
-                v.value = value.value
-            # set the value as constant if we found con
-            if token == 'con':
-                v.constant = True
-            # save the variable using its symbol's hash
-            variables[symbol.value] = v
+        elif kind is TokenType.Var or kind is TokenType.Con:
+            builtin_define(token)
         # if is a defined variable
-        # note we check the hash of the token + ':' to get its symbol name
-        elif (var_hash := hash(token+':')) in variables.keys():
+        elif kind is TokenType.Name and slot_kinds[value] != SLOT_FREE:
+            # the value of a name is its slot
+            address = VAR_START + value
+            # a constant holding a block is a word, using its name calls the block
+            if slot_kinds[value] == SLOT_CON and memory_types[address] == ValueType.Block:
+                interpret(block_tokens(memory_values[address]))
+                continue
+
              # increment stack top
             stack_top += 1 
+            if stack_top == stack_capacity:
+                stack_grow()
 
-            # get variable
-            v = variables[var_hash]
             # if constant push the value
-            if v.constant:
+            if slot_kinds[value] == SLOT_CON:
+                # set the type to the constant's type
+                stack_types[stack_top] = memory_types[address]
+                # assign the constant's value
+                stack_values[stack_top] = memory_values[address]
             # if not constant push the address
-                # set the type to Address
-                stack[stack_top].type = v.type
-                # assign the variables hash value
-                stack[stack_top].value = v.value
             else:
                 # set the type to Address
-                stack[stack_top].type = ValueType.Address
-                # assign the variables hash value
-                stack[stack_top].value = var_hash
+                stack_types[stack_top] = ValueType.Address
+                # assign the variable's address
+                stack_values[stack_top] = address
         # Undefined is simple
-        elif token == 'Undefined':
+        elif kind is TokenType.Undefined:
             # increment stack top
             stack_top += 1 
+            if stack_top == stack_capacity:
+                stack_grow()
             # set the type to Udnefined
-            stack[stack_top].type = ValueType.Undefined
+            stack_types[stack_top] = ValueType.Undefined
             # assign the value UNDEFINED
-            stack[stack_top].value = UNDEFINED
-         # read
-        elif token == '!':
-            # ! requires two arguments
-            if stack_top < 1:
-                error_stack_underflow('!')
-            
-            stack_invalid_types([ValueType.Any, ValueType.Address], word=token)
-
-            # get value
-            value = stack[stack_top]
-            stack_top -= 1
-
-            # get address
-            addr = stack[stack_top]
-            stack_top -= 1
-
-            # write the type and value
-            variables[addr.value].type = value.type
-            variables[addr.value].value = value.value
-
-        # # write
-        elif token == '@':
-            # ! requires one argument
-            if stack_top < 0:
-                error_stack_underflow('@')
-            
-            stack_invalid_types([ValueType.Address], word=token)
-
-            # get address
-            addr = stack[stack_top]
-            # don't modify stack top since we'll be pushing again anyway
-            # stack_top -= 1
-            # stack_top += 1
-            # get value
-            value = variables[addr.value]
-
-            # write the type and value to the stack
-            stack[stack_top].type = value.type
-            stack[stack_top].value = value.value
+            stack_values[stack_top] = UNDEFINED
+        # write
+        elif kind is TokenType.Write:
+            builtin_write()
+        # read
+        elif kind is TokenType.Read:
+            builtin_read()
         # strings
-        elif token.startswith('"') and token.endswith('"'):
+        elif kind is TokenType.String:
             # increment stack top
             stack_top += 1 
+            if stack_top == stack_capacity:
+                stack_grow()
             # set the type to string
-            stack[stack_top].type = ValueType.String
-            # assign the string without its leading and trailing "
-            stack[stack_top].value = token[1:-1]
+            stack_types[stack_top] = ValueType.String
+            # assign the string, compile_token already removed its leading and trailing "
+            stack_values[stack_top] = value
+        # blocks are pushed like any other value, they only run when they're called
+        elif kind is TokenType.Block:
+            stack_top += 1
+            if stack_top == stack_capacity:
+                stack_grow()
+            stack_types[stack_top] = ValueType.Block
+            stack_values[stack_top] = value
         # unkown token
         else:
-            # suggest what the dev might have meant
-            suggestion = ''
-            # we'll check if a symbol exists and suggest that to the user in case they meant to type it
-            if token + ':' in symbols.values():
-                suggestion = f', did you mean the Symbol {token+":"} ? If so you forgot the ending ":" (colon)'
-            raise XForthException(f'{location}ERROR: Undefined token {token}{suggestion}')
+            error_undefined_token(token)
+
+# Constant Folding
+# Expressions made only of literals, like 60 60 * 24 *, give the same result every time they run.
+# fold_constants works them out once while compiling and replaces them with a single literal
+# It also replaces the names of constants with their values when it knows them
+
+# the token types that just push a value
+LITERAL_TYPES = { TokenType.Number, TokenType.Bool, TokenType.String, TokenType.Undefined, TokenType.Symbol }
+# the most literals fold_constants holds back at once, so a long run of literals doesn't pile up in memory
+FOLD_WINDOW = 32
+
+def fold_operator(token: str, a: Token, b: Token) -> Optional[Token]:
+    '''fold_operator returns the literal token for a b <token> or None if it can't be folded because the types are wrong, which is left to error when it runs'''
+    operation, result_type, numbers_only = THREADED_OPERATORS[token]
+    if numbers_only and (a.type is not TokenType.Number or b.type is not TokenType.Number):
+        return None
+    # symbols are added to the symbols table when they're pushed, which wouldn't happen if we folded them away
+    if a.type is TokenType.Symbol or b.type is TokenType.Symbol:
+        return None
+    # Undefined is a symbol id, so comparing it needs values_equal
+    if a.type is TokenType.Undefined or b.type is TokenType.Undefined:
+        return None
+    # note that divide gives 0.0 when dividing by 0 just like the interpreter
+    result = operation(a.value, b.value)
+    # logic operators give True (0.0) or False (1.0)
+    if result_type is ValueType.Bool:
+        return Token(TokenType.Bool, TRUE if result else FALSE, 'True' if result else 'False')
+    return Token(TokenType.Number, result, repr(result))
+
+# the token type for the ValueType of a constant
+LITERAL_TOKEN_TYPES = {
+    ValueType.Number: TokenType.Number,
+    ValueType.Bool: TokenType.Bool,
+    ValueType.String: TokenType.String,
+    ValueType.Undefined: TokenType.Undefined,
+    ValueType.Symbol: TokenType.Symbol,
+}
+
+def constant_literal(slot: int) -> Optional[Token]:
+    '''constant_literal returns a literal token for a constant that already exists, constants can never change so it's safe to use its value'''
+    value_type = VALUE_TYPES[memory_types[VAR_START + slot]]
+    if slot_kinds[slot] != SLOT_CON or not value_type in LITERAL_TOKEN_TYPES:
+        return None
+    value = memory_values[VAR_START + slot]
+    # symbols need their name so they can be added to the symbols table
+    text = symbol_names[value] if value_type is ValueType.Symbol else repr(value)
+    return Token(LITERAL_TOKEN_TYPES[value_type], value, text)
+
+def fold_constants(tokens: Iterable[Token]) -> Iterator[Token]:
+    '''fold_constants lazily yields tokens with literal operations replaced by their results and known constants replaced by their values'''
+    # literals we've held back in case an operator follows them
+    pending = []
+    # the constants this program defines as <symbol> <literal> con
+    known = {}
+    for token in tokens:
+        kind = token.type
+        if kind is TokenType.Name:
+            literal = known.get(token.value) or constant_literal(token.value)
+            if literal is not None:
+                token = literal
+                kind = token.type
+        if kind in LITERAL_TYPES:
+            pending.append(token)
+            if len(pending) > FOLD_WINDOW:
+                yield pending.pop(0)
+            continue
+        if kind is TokenType.Operator and len(pending) >= 2:
+            folded = fold_operator(token.text, pending[-2], pending[-1])
+            if folded is not None:
+                pending[-2:] = [folded]
+                continue
+        # if the definition of a constant fails the program stops there, so the name can't be used after it
+        if kind is TokenType.Con and len(pending) >= 2 and pending[-2].type is TokenType.Symbol:
+            # names are compiled to the slot of their symbol
+            known[variable_slot(pending[-2].value)] = pending[-1]
+        yield from pending
+        pending.clear()
+        yield token
+    yield from pending
+
+# Control Flow
+# if and loop are words that take blocks, so run naively a program would push the blocks, and then if or loop would pop them
+# and call one for every branch taken and every time around the loop.
+# Almost always the blocks are written right before the word, so we know what they are when we compile.
+# lower_control_flow replaces them and the word with a single If or Loop token, which the vm compiles into jumps around and back over
+# the code of the blocks, all in the same program, and the threaded engine into a closure that runs the code of the blocks itself
+
+def lower_control_flow(tokens: Iterable[Token]) -> Iterator[Token]:
+    '''lower_control_flow lazily yields tokens with [ ... ] [ ... ] if and [ ... ] loop replaced by If and Loop tokens'''
+    # blocks we've held back in case an if or loop follows them
+    pending = []
+    for token in tokens:
+        kind = token.type
+        if kind is TokenType.Block:
+            pending.append(token)
+            # if only needs the last two
+            if len(pending) > 2:
+                yield pending.pop(0)
+            continue
+        if kind is TokenType.Function and token.text == 'if' and len(pending) == 2:
+            token = Token(TokenType.If, (pending[0].value, pending[1].value), token.text)
+            pending.clear()
+        elif kind is TokenType.Function and token.text == 'loop' and pending:
+            token = Token(TokenType.Loop, pending.pop().value, token.text)
+        yield from pending
+        pending.clear()
+        yield token
+    yield from pending
+
+def optimize_tokens(tokens: Iterable[Token]) -> Iterable[Token]:
+    '''optimize_tokens lowers if and loop and runs fold_constants over tokens unless --no-fold was passed'''
+    return lower_control_flow(fold_constants(tokens) if fold else tokens)
+
+# Threaded Code
+# interpret has to walk its if/elif chain for every token, so a word near the bottom of the chain pays for every test above it.
+# Instead we can compile each token into a small function (a closure) that already knows what to do, and then just call them one after another.
+# This is known as direct or closure threading and it is how many Forths are implemented
+ThreadedCode = List[Callable[[], None]]
+
+# the closures keep their own references to the stack arrays, reading a closure variable is faster than reading a global
+def thread_push(value_type: ValueType, value: Any) -> Callable[[], None]:
+    '''thread_push creates a word that pushes a value of value_type to the stack'''
+    types = stack_types
+    values = stack_values
+    def push():
+        global stack_top
+        stack_top += 1
+        if stack_top == stack_capacity:
+            stack_grow()
+        types[stack_top] = value_type
+        values[stack_top] = value
+    return push
+
+def thread_symbol(symbol_id: int, token: str) -> Callable[[], None]:
+    '''thread_symbol creates a word that pushes a symbol, adding it to the symbols table the first time it runs'''
+    types = stack_types
+    values = stack_values
+    def push_symbol():
+        global stack_top
+        if not symbol_id in symbols:
+            symbols[symbol_id] = token
+        stack_top += 1
+        if stack_top == stack_capacity:
+            stack_grow()
+        types[stack_top] = ValueType.Symbol
+        values[stack_top] = symbol_id
+    return push_symbol
+
+def thread_name(slot: int, token: str) -> Callable[[], None]:
+    '''thread_name creates a word that pushes a variable's address or a constant's value'''
+    types = stack_types
+    values = stack_values
+    kinds = slot_kinds
+    address = VAR_START + slot
+    def push_variable():
+        global stack_top
+        # the variable may not be defined yet when we compile, so we check its slot when we run
+        kind = kinds[slot]
+        if kind == SLOT_FREE:
+            error_undefined_token(token)
+        # a constant holding a block is a word, using its name calls the block
+        if kind == SLOT_CON and memory_types[address] == ValueType.Block:
+            run_threaded(block_threaded(memory_values[address]))
+            return
+        stack_top += 1
+        if stack_top == stack_capacity:
+            stack_grow()
+        if kind == SLOT_CON:
+            types[stack_top] = memory_types[address]
+            values[stack_top] = memory_values[address]
+        else:
+            types[stack_top] = ValueType.Address
+            values[stack_top] = address
+    return push_variable
+
+# these are the functions used by thread_operator
+def divide(a: float, b: float) -> float:
+    '''divide divides a by b, if we try to divide by zero we'll just get zero'''
+    return 0.0 if b == 0 else a / b
+
+import operator
+THREADED_OPERATORS = {
+    # math operators take two numbers and return a number
+    '+':  (operator.add, ValueType.Number, True),
+    '-':  (operator.sub, ValueType.Number, True),
+    '*':  (operator.mul, ValueType.Number, True),
+    '/':  (divide, ValueType.Number, True),
+    # logic operators return a bool, only < and > require numbers
+    '<':  (operator.lt, ValueType.Bool, True),
+    '>':  (operator.gt, ValueType.Bool, True),
+    '==': (operator.eq, ValueType.Bool, False),
+    '!=': (operator.ne, ValueType.Bool, False),
+}
+
+def thread_operator(token: str) -> Callable[[], None]:
+    '''thread_operator creates a word for one of the OPERATORS'''
+    operation, result_type, numbers_only = THREADED_OPERATORS[token]
+    Number = int(ValueType.Number)
+    is_bool = result_type == ValueType.Bool
+    result_type = int(result_type)
+    types = stack_types
+    values = stack_values
+    domains = EQUALITY_DOMAINS
+
+    def apply_operator():
+        global stack_top
+        if stack_top < 1:
+            error_stack_underflow(token)
+        stack_top -= 2
+        # checking the two types inline is much faster than building a list for stack_invalid_types
+        # so we only call it to raise the error
+        if numbers_only and (types[stack_top+1] != Number or types[stack_top+2] != Number):
+            stack_invalid_types([ValueType.Number, ValueType.Number], top=stack_top+2, word=token)
+        if not numbers_only and domains[types[stack_top+1]] != domains[types[stack_top+2]]:
+            # values from different domains are never equal, see values_equal
+            result = token == '!='
+        else:
+            result = operation(values[stack_top+1], values[stack_top+2])
+        # the result replaces a, which is in the slot we're pushing to
+        stack_top += 1
+        values[stack_top] = (TRUE if result else FALSE) if is_bool else result
+        types[stack_top] = result_type
+    return apply_operator
+
+def thread_if(then_block: Block, else_block: Block) -> Callable[[], None]:
+    '''thread_if creates a word for [ ... ] [ ... ] if that runs the code of one of the blocks, only the bool is on the stack'''
+    types = stack_types
+    values = stack_values
+    Bool = int(ValueType.Bool)
+    def run_if():
+        global stack_top
+        if stack_top < 0:
+            error_stack_underflow('if')
+        # the same error builtin_if gives, the bool would be under the two blocks
+        if types[stack_top] != Bool:
+            error_stack_invalid_types([ValueType.Bool], VALUE_TYPES[types[stack_top]], 2, 'if')
+        condition = values[stack_top]
+        stack_top -= 1
+        # the blocks are compiled the first time they run, so a branch that's never taken is never compiled
+        for word in block_threaded(then_block if condition == TRUE else else_block):
+            word()
+    return run_if
+
+def error_loop_types(top: int):
+    '''error_loop_types raises the error builtin_loop gives for a start and end that aren't both numbers, the two numbers would be under the block'''
+    for position, value_type in ((1, stack_types[top]), (2, stack_types[top-1])):
+        if value_type != ValueType.Number:
+            error_stack_invalid_types([ValueType.Number], VALUE_TYPES[value_type], position, 'loop')
+
+def thread_loop(body: Block) -> Callable[[], None]:
+    '''thread_loop creates a word for [ ... ] loop, the counted loop keeps its index in a local and only pushes it for the body'''
+    types = stack_types
+    values = stack_values
+    Number = int(ValueType.Number)
+    def run_loop():
+        global stack_top
+        if stack_top < 1:
+            error_stack_underflow('loop')
+        if types[stack_top] != Number or types[stack_top-1] != Number:
+            error_loop_types(stack_top)
+        index = values[stack_top-1]
+        end = values[stack_top]
+        stack_top -= 2
+        code = block_threaded(body)
+        while index < end:
+            stack_top += 1
+            if stack_top == stack_capacity:
+                stack_grow()
+            types[stack_top] = Number
+            values[stack_top] = index
+            for word in code:
+                word()
+            index += 1
+    return run_loop
+
+def thread_token(token: Token) -> Callable[[], None]:
+    '''thread_token compiles a single token into the function that executes it'''
+    kind, value, text = token
+    if kind is TokenType.Number:
+        return thread_push(ValueType.Number, value)
+    elif kind is TokenType.Operator:
+        return thread_operator(text)
+    elif kind is TokenType.Function:
+        return value
+    elif kind is TokenType.Symbol:
+        return thread_symbol(value, text)
+    elif kind is TokenType.Bool:
+        return thread_push(ValueType.Bool, value)
+    elif kind is TokenType.Var or kind is TokenType.Con:
+        return lambda: builtin_define(text)
+    elif kind is TokenType.Name:
+        return thread_name(value, text)
+    elif kind is TokenType.Undefined:
+        return thread_push(ValueType.Undefined, UNDEFINED)
+    elif kind is TokenType.Write:
+        return builtin_write
+    elif kind is TokenType.Read:
+        return builtin_read
+    elif kind is TokenType.String:
+        return thread_push(ValueType.String, value)
+    elif kind is TokenType.Block:
+        return thread_push(ValueType.Block, value)
+    elif kind is TokenType.If:
+        return thread_if(*value)
+    elif kind is TokenType.Loop:
+        return thread_loop(value)
+    raise XForthException(f'{location}ERROR: Undefined token {text}')
+
+def compile_threaded(tokens: Iterable[Token]) -> ThreadedCode:
+    '''compile_threaded compiles tokens into a list of functions that can be run with run_threaded'''
+    return [ thread_token(token) for token in tokens ]
+
+def run_threaded(code: Iterable[Callable[[], None]]):
+    '''run_threaded runs threaded code, there is nothing left to decide so we just call each word in turn'''
+    for word in code:
+        word()
+
+# Bytecode
+# Our third engine compiles tokens into X-? (Bytecode): a flat array of integers along with a pool of constants.
+# Every instruction is two integers, an opcode and an argument, which is an index into the constant pool for instructions that need one
+# The spec asks for values to be NaN boxed or pointer tagged. Python floats are already heap objects so packing a tag into the
+# bits of a NaN would cost us a struct.pack on every push. Instead each constant in the pool is stored already tagged as a (ValueType, value) pair
+
+# opcodes
+OP_PUSH = 0     # push constants[arg], a (ValueType, value) pair
+OP_NAME = 1     # push the variable or constant named by constants[arg], a (slot, token) pair
+OP_READ = 2     # @
+OP_WRITE = 3    # !
+OP_ADD = 4
+OP_SUB = 5
+OP_MUL = 6
+OP_DIV = 7
+OP_LT = 8
+OP_GT = 9
+OP_EQ = 10
+OP_NE = 11
+OP_CALL = 12    # call the FUNC_TABLE function constants[arg]
+OP_SYMBOL = 13  # push the symbol constants[arg], an (id, token) pair
+OP_DEFINE = 14  # var or con, constants[arg] is the word
+# superinstructions, these are made by optimize from common sequences of instructions so they only cost a single dispatch
+# constants[arg] holds what they need followed by a fallback Program of the instructions they replaced
+OP_LOAD = 15                # <name> @
+OP_SQUARE = 16              # dup *
+OP_PUSH_OPERATOR = 17       # <literal> <operator>, ex. 1 + or 0 ==
+OP_LOAD_LOAD_OPERATOR = 18  # <name> @ <name> @ <operator>, ex. a @ b @ +
+# unchecked instructions, these are swapped in by infer_types when it can prove an instruction's arguments are always there and the right type
+OP_PUSH_OPERATOR_UNCHECKED = 19  # OP_PUSH_OPERATOR without the type check
+OP_ADD_UNCHECKED = 20
+OP_SUB_UNCHECKED = 21
+OP_MUL_UNCHECKED = 22
+OP_DIV_UNCHECKED = 23
+OP_LT_UNCHECKED = 24
+OP_GT_UNCHECKED = 25
+OP_EQ_UNCHECKED = 26
+OP_NE_UNCHECKED = 27
+# control flow, made by compile_bytecode for If and Loop tokens. The argument is how far to jump, counted in ints from the next instruction
+OP_JUMP = 28        # jump by arg
+OP_BRANCH = 29      # pop a bool and jump by arg unless it's True, the start of an if
+OP_LOOP = 30        # pop start and end, jump by arg if there's nothing to count, otherwise start counting and push the index
+OP_LOOP_NEXT = 31   # count up, if we haven't reached the end push the index and jump back by arg to the start of the body
+OP_CALL_BLOCK = 32  # VM_BLOCK_WORDS[arg] with its blocks taken from the stack, the vm runs the block itself rather than calling the builtin
+
+# the words OP_CALL_BLOCK runs, these call blocks so the vm handles them to keep the calls on its return stack
+VM_BLOCK_WORDS = [ 'call', 'apply', 'if', 'loop' ]
+
+# the names of the opcodes, used by disassemble
+OP_NAMES = [ name[3:] for name, op in sorted(((n, v) for n, v in globals().items() if n.startswith('OP_') and isinstance(v, int)), key=lambda item: item[1]) ]
+
+# the opcode of each operator
+OPERATOR_OPCODES = {
+    '+': OP_ADD,
+    '-': OP_SUB,
+    '*': OP_MUL,
+    '/': OP_DIV,
+    '<': OP_LT,
+    '>': OP_GT,
+    '==': OP_EQ,
+    '!=': OP_NE,
+}
+
+# the opcodes whose argument is an index into the constant pool
+POOL_OPS = { OP_PUSH, OP_NAME, OP_CALL, OP_SYMBOL, OP_DEFINE, OP_LOAD, OP_SQUARE, OP_PUSH_OPERATOR, OP_LOAD_LOAD_OPERATOR, OP_PUSH_OPERATOR_UNCHECKED }
+# the opcodes whose constant ends with a fallback program
+SUPER_OPS = { OP_LOAD, OP_SQUARE, OP_PUSH_OPERATOR, OP_LOAD_LOAD_OPERATOR, OP_PUSH_OPERATOR_UNCHECKED }
+# the opcodes whose argument is a jump
+JUMP_OPS = { OP_JUMP, OP_BRANCH, OP_LOOP, OP_LOOP_NEXT }
+
+@dataclass
+class Program:
+    '''Program is a compiled bytecode program'''
+    # pairs of opcode and argument
+    code: array
+    # the constant pool
+    constants: List[Any]
+
+class ProgramBuilder:
+    '''ProgramBuilder emits instructions and deduplicates the constants they use'''
+    def __init__(self):
+        self.code = array('i')
+        self.constants = []
+        # maps constants to their index in the pool
+        self.constant_indices = {}
+
+    def constant(self, value: Any) -> int:
+        '''constant returns the index of value in the constant pool, adding it if it isn't there yet'''
+        # we key on repr so 0.0 and -0.0 or 1.0 and True don't get merged
+        key = (type(value), repr(value))
+        index = self.constant_indices.get(key)
+        if index is None:
+            index = self.constant_indices[key] = len(self.constants)
+            self.constants.append(value)
+        return index
+
+    def emit(self, op: int, arg: int = 0):
+        self.code.append(op)
+        self.code.append(arg)
+
+    def jump(self, op: int) -> int:
+        '''jump emits a jump whose target isn't known yet and returns where it is, so land can point it at its target later'''
+        self.emit(op)
+        return len(self.code)
+
+    def land(self, jump: int):
+        '''land points the jump emitted at jump to the next instruction emitted'''
+        self.code[jump-1] = len(self.code) - jump
+
+    def build(self) -> Program:
+        return Program(self.code, self.constants)
+
+def compile_bytecode(tokens: Iterable[Token]) -> Program:
+    '''compile_bytecode compiles tokens into a bytecode Program that can be run with run_program'''
+    builder = ProgramBuilder()
+    compile_into(builder, tokens)
+    # a jump that lands on a jump can go straight to where that one goes. Nested ifs end with a chain of them,
+    # this way a block that ends with an if jumps right to its end, which is how the vm spots a call in tail position
+    code = builder.code
+    for ip in range(0, len(code), 2):
+        if code[ip] == OP_JUMP:
+            target = ip + 2 + code[ip+1]
+            while target < len(code) and code[target] == OP_JUMP:
+                target += 2 + code[target+1]
+            code[ip+1] = target - ip - 2
+    return builder.build()
+
+def compile_into(builder: ProgramBuilder, tokens: Iterable[Token]):
+    '''compile_into emits the bytecode for tokens with builder. The blocks of if and loop are compiled in place, between their jumps'''
+    emit = builder.emit
+    constant = builder.constant
+    for kind, value, text in tokens:
+        if kind is TokenType.Number:
+            emit(OP_PUSH, constant((ValueType.Number, value)))
+        elif kind is TokenType.Operator:
+            emit(OPERATOR_OPCODES[text])
+        elif kind is TokenType.Function and text in VM_BLOCK_WORDS:
+            emit(OP_CALL_BLOCK, VM_BLOCK_WORDS.index(text))
+        elif kind is TokenType.Function:
+            emit(OP_CALL, constant(value))
+        elif kind is TokenType.Symbol:
+            emit(OP_SYMBOL, constant((value, text)))
+        elif kind is TokenType.Bool:
+            emit(OP_PUSH, constant((ValueType.Bool, value)))
+        elif kind is TokenType.Var or kind is TokenType.Con:
+            emit(OP_DEFINE, constant(text))
+        elif kind is TokenType.Name:
+            emit(OP_NAME, constant((value, text)))
+        elif kind is TokenType.Undefined:
+            emit(OP_PUSH, constant((ValueType.Undefined, UNDEFINED)))
+        elif kind is TokenType.Write:
+            emit(OP_WRITE)
+        elif kind is TokenType.Read:
+            emit(OP_READ)
+        elif kind is TokenType.String:
+            emit(OP_PUSH, constant((ValueType.String, value)))
+        elif kind is TokenType.Block:
+            emit(OP_PUSH, constant((ValueType.Block, value)))
+        # BRANCH else <then> JUMP end else: <else> end:
+        elif kind is TokenType.If:
+            then_block, else_block = value
+            to_else = builder.jump(OP_BRANCH)
+            compile_into(builder, optimize_tokens(block_tokens(then_block)))
+            # an empty else doesn't need the then to jump over it
+            if block_length(else_block):
+                to_end = builder.jump(OP_JUMP)
+                builder.land(to_else)
+                compile_into(builder, optimize_tokens(block_tokens(else_block)))
+                builder.land(to_end)
+            else:
+                builder.land(to_else)
+        # LOOP end body: <body> LOOP_NEXT body end:
+        elif kind is TokenType.Loop:
+            to_end = builder.jump(OP_LOOP)
+            body = len(builder.code)
+            compile_into(builder, optimize_tokens(block_tokens(value)))
+            emit(OP_LOOP_NEXT, body - len(builder.code) - 2)
+            builder.land(to_end)
+        else:
+            raise XForthException(f'{location}ERROR: Undefined token {text}')
+
+def disassemble(program: Program) -> str:
+    '''disassemble returns a readable listing of a program, one instruction per line'''
+    code = program.code
+    # show function words by name rather than as a function
+    function_names = { function: name for name, function in FUNC_TABLE.items() }
+    lines = []
+    for ip in range(0, len(code), 2):
+        op, arg = code[ip], code[ip+1]
+        # only show the argument for instructions that use the constant pool
+        if op == OP_CALL:
+            operand = function_names.get(program.constants[arg], repr(program.constants[arg]))
+        elif op in SUPER_OPS:
+            # leave out the fallback program
+            operand = repr(program.constants[arg][:-1])
+        elif op in POOL_OPS:
+            operand = repr(program.constants[arg])
+        # show where jumps land
+        elif op in JUMP_OPS:
+            operand = f'-> {ip + 2 + arg}'
+        elif op == OP_CALL_BLOCK:
+            operand = VM_BLOCK_WORDS[arg]
+        else:
+            operand = ''
+        lines.append(f'{ip:6} {OP_NAMES[op]:<8} {operand}')
+    return '\n'.join(lines)
+
+# the return stack, where the vm keeps the frame each call returns to as a (code, constants, ip) tuple.
+# Calls never make a Python call, so how deep words can call each other is only limited by its size
+RETURN_STACK_CAPACITY = int(return_limit) if str(return_limit).isdigit() else 0
+return_stack: List[Tuple[array, List[Any], int]] = []
+
+def error_return_overflow():
+    '''error_return_overflow is raised when a call would push more frames than the return stack can hold'''
+    raise XForthException(f'{location}ERROR: Return stack overflow, the vm can only be {RETURN_STACK_CAPACITY} calls deep, use --return-stack=<n> to raise the limit')
+
+def run_program(program: Program):
+    '''run_program is the virtual machine that executes bytecode programs.
+
+    stack_top is kept in the local top while we run because locals are much faster than globals in Python.
+    That means we must copy it back to stack_top before calling anything that uses the stack, and read it again afterwards'''
+    global stack_top
+    code = program.code
+    constants = program.constants
+    # cache everything the loop uses in locals
+    # the types are plain ints since the arrays read and write those faster than ValueType members
+    Number = int(ValueType.Number)
+    Bool = int(ValueType.Bool)
+    Address = int(ValueType.Address)
+    Symbol = int(ValueType.Symbol)
+    Block = int(ValueType.Block)
+    types = stack_types
+    values = stack_values
+    domains = EQUALITY_DOMAINS
+    kinds = slot_kinds
+    mem_types = memory_types
+    mem_values = memory_values
+    var_start = VAR_START
+    true = TRUE
+    false = FALSE
+    top = stack_top
+    # our copy of the capacity goes out of date when a word we call grows the stack, so pushes check top >= capacity
+    # and stack_grow hands back the real capacity without growing when there's still room
+    capacity = stack_capacity
+    # the [index, end] of each counted loop we're in, the innermost is last. The index lives here rather than on the stack
+    loops = []
+    ip = 0
+    end = len(code)
+    # calls push a frame to return to on the shared return stack, the frames under base belong to whatever called us
+    frames = return_stack
+    base = len(frames)
+    frame_limit = RETURN_STACK_CAPACITY
+    while True:
+        while ip < end:
+            op = code[ip]
+            arg = code[ip+1]
+            ip += 2
+            # the most common instructions come first
+            if op == 0: # OP_PUSH
+                top += 1
+                if top >= capacity:
+                    stack_top = top
+                    capacity = stack_grow()
+                types[top], values[top] = constants[arg]
+            elif op == 1: # OP_NAME
+                slot, token = constants[arg]
+                kind = kinds[slot]
+                if kind == 0: # SLOT_FREE
+                    stack_top = top
+                    error_undefined_token(token)
+                # a constant holding a block is a word, using its name calls the block
+                if kind == 2 and mem_types[var_start + slot] == Block:
+                    callee = block_program(mem_values[var_start + slot])
+                    # a call in tail position has nothing left to return to, so it replaces our frame instead of pushing one,
+                    # that's when it's the last instruction or is followed by a jump to the end. See compile_bytecode
+                    if ip != end and not (code[ip] == 28 and ip + 2 + code[ip+1] == end):
+                        if len(frames) == frame_limit:
+                            stack_top = top
+                            error_return_overflow()
+                        frames.append((code, constants, ip))
+                    code = callee.code
+                    constants = callee.constants
+                    ip = 0
+                    end = len(code)
+                    continue
+                top += 1
+                if top >= capacity:
+                    stack_top = top
+                    capacity = stack_grow()
+                if kind == 2: # SLOT_CON
+                    types[top] = mem_types[var_start + slot]
+                    values[top] = mem_values[var_start + slot]
+                else:
+                    types[top] = Address
+                    values[top] = var_start + slot
+            elif op >= 28: # control flow
+                if op == 32: # OP_CALL_BLOCK
+                    stack_top = top
+                    # like a word, a block called in tail position replaces our frame
+                    tail = ip == end or (code[ip] == 28 and ip + 2 + code[ip+1] == end)
+                    if arg == 0: # call ( block -- ? )
+                        if top < 0:
+                            error_stack_underflow('call')
+                        if types[top] != Block:
+                            stack_invalid_types([ValueType.Block], word='call')
+                        callee = block_program(values[top])
+                        top -= 1
+                    elif arg == 2: # if ( bool block block -- ? )
+                        if top < 2:
+                            error_stack_underflow('if')
+                        if types[top] != Block or types[top-1] != Block or types[top-2] != Bool:
+                            stack_invalid_types([ValueType.Block, ValueType.Block, ValueType.Bool], word='if')
+                        callee = block_program(values[top-1] if values[top-2] == true else values[top])
+                        top -= 3
+                    elif arg == 3: # loop ( start end block -- ? ), OP_LOOP at the start of the looped code pops start and end
+                        if top < 2:
+                            error_stack_underflow('loop')
+                        if types[top] != Block:
+                            stack_invalid_types([ValueType.Block], word='loop')
+                        callee = block_looped(values[top])
+                        top -= 1
+                    else: # apply ( block block -- ? )
+                        if top < 1:
+                            error_stack_underflow('apply')
+                        if types[top] != Block or types[top-1] != Block:
+                            stack_invalid_types([ValueType.Block, ValueType.Block], word='apply')
+                        if len(frames) + 1 >= frame_limit:
+                            error_return_overflow()
+                        # the arguments block runs first and returns to the start of the body, which returns to us
+                        body = block_program(values[top-1])
+                        callee = block_program(values[top])
+                        top -= 2
+                        if not tail:
+                            frames.append((code, constants, ip))
+                        code, constants, ip = body.code, body.constants, 0
+                        tail = False
+                    if not tail:
+                        if len(frames) == frame_limit:
+                            error_return_overflow()
+                        frames.append((code, constants, ip))
+                    code = callee.code
+                    constants = callee.constants
+                    ip = 0
+                    end = len(code)
+                elif op == 31: # OP_LOOP_NEXT
+                    counter = loops[-1]
+                    index = counter[0] + 1
+                    if index < counter[1]:
+                        counter[0] = index
+                        top += 1
+                        if top >= capacity:
+                            stack_top = top
+                            capacity = stack_grow()
+                        types[top] = Number
+                        values[top] = index
+                        ip += arg
+                    else:
+                        loops.pop()
+                elif op == 29: # OP_BRANCH
+                    if top < 0:
+                        stack_top = top
+                        error_stack_underflow('if')
+                    if types[top] != Bool:
+                        stack_top = top
+                        error_stack_invalid_types([ValueType.Bool], VALUE_TYPES[types[top]], 2, 'if')
+                    if values[top] != true:
+                        ip += arg
+                    top -= 1
+                elif op == 28: # OP_JUMP
+                    ip += arg
+                else: # OP_LOOP
+                    if top < 1:
+                        stack_top = top
+                        error_stack_underflow('loop')
+                    if types[top] != Number or types[top-1] != Number:
+                        stack_top = top
+                        error_loop_types(top)
+                    index = values[top-1]
+                    loop_end = values[top]
+                    if index < loop_end:
+                        loops.append([index, loop_end])
+                        # start is the first index, so it stays on the stack for the first run of the body and only end is popped
+                        top -= 1
+                    else:
+                        top -= 2
+                        ip += arg
+            elif op >= 19: # unchecked instructions
+                if op == 19: # OP_PUSH_OPERATOR_UNCHECKED
+                    value, operation, is_bool, _, _ = constants[arg]
+                    result = operation(values[top], value)
+                    if is_bool:
+                        values[top] = true if result else false
+                        types[top] = Bool
+                    else:
+                        values[top] = result
+                        types[top] = Number
+                    continue
+                # the unchecked operators
+                b_value = values[top]
+                top -= 1
+                a_value = values[top]
+                if op == 20:
+                    values[top] = a_value + b_value
+                elif op == 21:
+                    values[top] = a_value - b_value
+                elif op == 22:
+                    values[top] = a_value * b_value
+                elif op == 23:
+                    values[top] = 0.0 if b_value == 0 else a_value / b_value
+                else:
+                    if op == 24:
+                        result = a_value < b_value
+                    elif op == 25:
+                        result = a_value > b_value
+                    elif op == 26:
+                        result = a_value == b_value and domains[types[top]] == domains[types[top+1]]
+                    else:
+                        result = a_value != b_value or domains[types[top]] != domains[types[top+1]]
+                    values[top] = true if result else false
+                    types[top] = Bool
+                    continue
+                types[top] = Number
+            elif op >= 15: # superinstructions
+                payload = constants[arg]
+                if op == 15: # OP_LOAD
+                    slot = payload[0]
+                    if kinds[slot] == 1: # SLOT_VAR
+                        top += 1
+                        if top >= capacity:
+                            stack_top = top
+                            capacity = stack_grow()
+                        types[top] = mem_types[var_start + slot]
+                        values[top] = mem_values[var_start + slot]
+                        continue
+                elif op == 17: # OP_PUSH_OPERATOR
+                    value, operation, is_bool, numbers_only, _ = payload
+                    # fuse_push_operator only fuses domain 0 values, so == can compare the values as long as the top is in domain 0 too
+                    if top >= 0 and (types[top] == Number if numbers_only else not domains[types[top]]):
+                        result = operation(values[top], value)
+                        if is_bool:
+                            values[top] = true if result else false
+                            types[top] = Bool
+                        else:
+                            values[top] = result
+                            types[top] = Number
+                        continue
+                elif op == 16: # OP_SQUARE
+                    if top >= 0 and types[top] == Number:
+                        a_value = values[top]
+                        values[top] = a_value * a_value
+                        continue
+                else: # OP_LOAD_LOAD_OPERATOR
+                    a_slot, b_slot, operation, is_bool, numbers_only, _ = payload
+                    a_type = mem_types[var_start + a_slot]
+                    b_type = mem_types[var_start + b_slot]
+                    if (kinds[a_slot] == 1 and kinds[b_slot] == 1
+                            and ((a_type == Number and b_type == Number) if numbers_only else domains[a_type] == domains[b_type])):
+                        result = operation(mem_values[var_start + a_slot], mem_values[var_start + b_slot])
+                        top += 1
+                        if top >= capacity:
+                            stack_top = top
+                            capacity = stack_grow()
+                        if is_bool:
+                            values[top] = true if result else false
+                            types[top] = Bool
+                        else:
+                            values[top] = result
+                            types[top] = Number
+                        continue
+                # anything unusual, like an error, is left to the instructions we replaced, which we run like a word
+                callee = payload[-1]
+                if len(frames) == frame_limit:
+                    stack_top = top
+                    error_return_overflow()
+                frames.append((code, constants, ip))
+                code = callee.code
+                constants = callee.constants
+                ip = 0
+                end = len(code)
+            elif op <= 3: # OP_READ and OP_WRITE
+                stack_top = top
+                if op == 2:
+                    builtin_read()
+                else:
+                    builtin_write()
+                top = stack_top
+            elif op <= 11: # the operators
+                if top < 1:
+                    stack_top = top
+                    error_stack_underflow(OPERATOR_TOKENS[op])
+                a_value = values[top-1]
+                b_value = values[top]
+                # everything but == and != requires numbers
+                if op <= 9 and (types[top-1] != Number or types[top] != Number):
+                    # the arguments have already been popped when the error is raised
+                    stack_top = top - 2
+                    stack_invalid_types([ValueType.Number, ValueType.Number], top=top, word=OPERATOR_TOKENS[op])
+                top -= 1
+                if op == 4:
+                    values[top] = a_value + b_value
+                elif op == 5:
+                    values[top] = a_value - b_value
+                elif op == 6:
+                    values[top] = a_value * b_value
+                elif op == 7:
+                    # for now if we try to divide by zero we'll just get zero
+                    values[top] = 0.0 if b_value == 0 else a_value / b_value
+                else:
+                    if op == 8:
+                        result = a_value < b_value
+                    elif op == 9:
+                        result = a_value > b_value
+                    elif op == 10:
+                        result = a_value == b_value and domains[types[top]] == domains[types[top+1]]
+                    else:
+                        result = a_value != b_value or domains[types[top]] != domains[types[top+1]]
+                    values[top] = true if result else false
+                    types[top] = Bool
+                    continue
+                types[top] = Number
+            elif op == 12: # OP_CALL
+                stack_top = top
+                constants[arg]()
+                top = stack_top
+            elif op == 13: # OP_SYMBOL
+                symbol_id, token = constants[arg]
+                if not symbol_id in symbols:
+                    symbols[symbol_id] = token
+                top += 1
+                if top >= capacity:
+                    stack_top = top
+                    capacity = stack_grow()
+                types[top] = Symbol
+                values[top] = symbol_id
+            else: # OP_DEFINE
+                stack_top = top
+                builtin_define(constants[arg])
+                top = stack_top
+        # the end of a word's code returns to where it was called from, or we're done
+        if len(frames) == base:
+            break
+        code, constants, ip = frames.pop()
+        end = len(code)
+    stack_top = top
+
+# the token for each operator opcode, used for errors
+OPERATOR_TOKENS = { op: token for token, op in OPERATOR_OPCODES.items() }
+
+# Peephole Optimizer
+# optimize looks through a program for short sequences of instructions, known as peepholes, that match a pattern
+# and replaces them with a single superinstruction. A superinstruction only handles the common case, like both values being numbers,
+# everything else is handled by running the instructions it replaced, so it always does exactly the same thing
+
+# (operation, result type, numbers only) for each operator opcode
+OPCODE_OPERATIONS = { OPERATOR_OPCODES[token]: operation for token, operation in THREADED_OPERATORS.items() }
+
+Instruction = Tuple[int, int]
+
+@dataclass
+class Fusion:
+    '''Fusion describes a sequence of instructions that can be replaced with a superinstruction'''
+    name: str
+    # a set of allowed opcodes for each instruction in the sequence
+    pattern: Tuple[set, ...]
+    # the superinstruction that replaces them
+    opcode: int
+    # given the matched instructions and the constant pool, fuse returns the constant for the superinstruction
+    # or None if these particular instructions can't be fused
+    fuse: Callable[[List[Instruction], List[Any]], Optional[tuple]]
+
+def fuse_load(instructions: List[Instruction], constants: List[Any]) -> Optional[tuple]:
+    '''<name> @'''
+    (_, name), _ = instructions
+    slot, _ = constants[name]
+    return (slot,)
+
+def fuse_square(instructions: List[Instruction], constants: List[Any]) -> Optional[tuple]:
+    '''dup *'''
+    (_, function), _ = instructions
+    return () if constants[function] is FUNC_TABLE['dup'] else None
+
+def fuse_push_operator(instructions: List[Instruction], constants: List[Any]) -> Optional[tuple]:
+    '''<literal> <operator>'''
+    (_, literal), (op, _) = instructions
+    value_type, value = constants[literal]
+    operation, result_type, numbers_only = OPCODE_OPERATIONS[op]
+    # this would always fall back
+    if numbers_only and value_type is not ValueType.Number:
+        return None
+    # comparing Undefined needs the type of the other value, see values_equal
+    if EQUALITY_DOMAINS[value_type]:
+        return None
+    return (value, operation, result_type is ValueType.Bool, numbers_only)
+
+def fuse_load_load_operator(instructions: List[Instruction], constants: List[Any]) -> Optional[tuple]:
+    '''<name> @ <name> @ <operator>, made from two OP_LOADs'''
+    (_, a), (_, b), (op, _) = instructions
+    operation, result_type, numbers_only = OPCODE_OPERATIONS[op]
+    return (constants[a][0], constants[b][0], operation, result_type is ValueType.Bool, numbers_only)
+
+OPERATOR_OPS = set(OPERATOR_OPCODES.values())
+
+# the fusions optimize tries, in order. Fusions can match superinstructions made by earlier fusions
+FUSIONS = [
+    Fusion('load', ({OP_NAME}, {OP_READ}), OP_LOAD, fuse_load),
+    Fusion('square', ({OP_CALL}, {OP_MUL}), OP_SQUARE, fuse_square),
+    Fusion('push-operator', ({OP_PUSH}, OPERATOR_OPS), OP_PUSH_OPERATOR, fuse_push_operator),
+    Fusion('load-load-operator', ({OP_LOAD}, {OP_LOAD}, OPERATOR_OPS), OP_LOAD_LOAD_OPERATOR, fuse_load_load_operator),
+]
+
+def build_program(instructions: List[Instruction], constants: List[Any]) -> Program:
+    '''build_program builds a Program from instructions whose arguments index into constants, keeping only the constants it uses'''
+    builder = ProgramBuilder()
+    for op, arg in instructions:
+        builder.emit(op, builder.constant(constants[arg]) if op in POOL_OPS else arg)
+    return builder.build()
+
+def optimize(program: Program, fusions: List[Fusion] = FUSIONS) -> Program:
+    '''optimize replaces the sequences of instructions matched by fusions with superinstructions'''
+    code = program.code
+    # fusing changes how far apart instructions are, so while we optimize jumps hold the index of the instruction they land on
+    instructions = []
+    for ip in range(0, len(code), 2):
+        op, arg = code[ip], code[ip+1]
+        instructions.append((op, (ip + 2 + arg) // 2 if op in JUMP_OPS else arg))
+    # we'll add the superinstruction constants to a copy of the pool
+    constants = list(program.constants)
+    for fusion in fusions:
+        size = len(fusion.pattern)
+        # a jump can land at the start of a superinstruction but not in the middle of one
+        targets = { arg for op, arg in instructions if op in JUMP_OPS }
+        optimized = []
+        # the index each instruction ends up at, plus the end for jumps out of the end of the program
+        moved = []
+        i = 0
+        while i < len(instructions):
+            window = instructions[i:i+size]
+            if (len(window) == size and all(op in allowed for (op, _), allowed in zip(window, fusion.pattern))
+                    and not any(j in targets for j in range(i+1, i+size))):
+                payload = fusion.fuse(window, constants)
+                if payload is not None:
+                    constants.append(payload + (build_program(window, constants),))
+                    moved += [len(optimized)] * size
+                    optimized.append((fusion.opcode, len(constants) - 1))
+                    i += size
+                    continue
+            moved.append(len(optimized))
+            optimized.append(instructions[i])
+            i += 1
+        moved.append(len(optimized))
+        instructions = [ (op, moved[arg]) if op in JUMP_OPS else (op, arg) for op, arg in optimized ]
+    # and back to how far to jump
+    instructions = [ (op, (arg - i - 1) * 2) if op in JUMP_OPS else (op, arg) for i, (op, arg) in enumerate(instructions) ]
+    return build_program(instructions, constants)
+
+# Type Inference
+# infer_types follows a program from start to end keeping track of what it knows about the stack.
+# When it can prove an instruction's arguments are on the stack and are the right type, it swaps in an unchecked version of the instruction.
+# Between jumps programs are straight line code, so whatever is known before an instruction holds every time it runs.
+# An instruction a jump lands on can be reached from more than one place, so there we start over knowing nothing
+
+# the number of values each builtin pops and the types it pushes back, dup is handled on its own since it copies a type
+BUILTIN_EFFECTS = {
+    '.': (1, ()),
+    '.s': (0, ()),
+    'drop': (1, ()),
+    'show': (0, ()),
+    'type': (1, (ValueType.Symbol,)),
+    'to-bool': (1, (ValueType.Bool,)),
+    'to-number': (1, (ValueType.Number,)),
+    'length': (1, (ValueType.Number,)),
+    'append': (2, (ValueType.String,)),
+    'to-string': (1, (ValueType.String,)),
+    'symbol-from-string': (1, (ValueType.Symbol,)),
+    'region': (1, (ValueType.Number, ValueType.Number)),
+    'c@': (1, (ValueType.Number,)),
+    'w@': (1, (ValueType.Number,)),
+    'i@': (1, (ValueType.Number,)),
+    'f@': (1, (ValueType.Number,)),
+    'c!': (2, ()),
+    'w!': (2, ()),
+    'i!': (2, ()),
+    'f!': (2, ()),
+    'save-image': (1, ()),
+    'get': (2, (ValueType.Any,)),
+    'put': (3, ()),
+    'sum': (1, (ValueType.Number,)),
+    'min': (1, (ValueType.Number,)),
+    'max': (1, (ValueType.Number,)),
+}
+
+# the unchecked version of each operator
+UNCHECKED_OPCODES = { op: op + OP_ADD_UNCHECKED - OP_ADD for op in OPERATOR_OPCODES.values() }
+
+def is_word(slot: int) -> bool:
+    '''is_word returns whether slot is already a constant holding a block, whose name calls the block'''
+    return slot_kinds[slot] == SLOT_CON and memory_types[VAR_START + slot] == ValueType.Block
+
+# the builtins that call a block they're given
+BLOCK_CALLING_WORDS = { 'call', 'apply', 'map', 'filter', 'reduce', 'if', 'loop' }
+
+def jump_targets(code: array) -> Dict[int, List[ValueType]]:
+    '''jump_targets maps the ip of every instruction a jump lands on to the types known to be on the top of the stack when it's reached'''
+    targets = {}
+    for ip in range(0, len(code), 2):
+        op, arg = code[ip], code[ip+1]
+        if op in JUMP_OPS:
+            # the start of a loop's body is reached with the index on the top, however it's reached
+            known = [ValueType.Number] if op == OP_LOOP_NEXT else []
+            targets[ip + 2 + arg] = known if targets.get(ip + 2 + arg, known) == known else []
+    return targets
+
+def may_define_words(program: Program) -> bool:
+    '''may_define_words returns whether running program could turn a name into a word by defining it as a constant holding a block.
+
+    A constant is only ever defined once, so this can only happen if program has a block it could define a constant with, or calls a block,
+    or defines a constant with a value that isn't a literal'''
+    code = program.code
+    constants = program.constants
+    function_names = { function: name for name, function in FUNC_TABLE.items() }
+    targets = jump_targets(code)
+    for ip in range(0, len(code), 2):
+        op, arg = code[ip], code[ip+1]
+        if op == OP_PUSH and constants[arg][0] is ValueType.Block:
+            return True
+        if (op == OP_CALL and function_names.get(constants[arg]) in BLOCK_CALLING_WORDS) or op == OP_CALL_BLOCK:
+            return True
+        if (op == OP_NAME or op == OP_LOAD) and is_word(constants[arg][0]):
+            return True
+        # <symbol> <literal> con, the literal isn't a block or we'd have returned already. If a jump lands in it something else could be on the stack
+        if op == OP_DEFINE and constants[arg] == 'con' and not (ip >= 4 and code[ip-4] == OP_SYMBOL and code[ip-2] == OP_PUSH
+                                                                 and ip not in targets and ip-2 not in targets):
+            return True
+    return False
+
+def infer_types(program: Program, kept: bool = False) -> Program:
+    '''infer_types returns a copy of program using unchecked instructions wherever it can prove their checks would pass.
+    kept is True for the code of a block, which is compiled once and run again every time the block is called'''
+    code = array('i', program.code)
+    constants = program.constants
+    function_names = { function: name for name, function in FUNC_TABLE.items() }
+    Number = ValueType.Number
+    Bool = ValueType.Bool
+    # using the name of a word calls its block, which could do anything to the stack.
+    # a name that isn't defined yet can only be a word if the program could make it one,
+    # or for kept code, if anything run between now and a later run of the code does
+    words_defined = kept or may_define_words(program)
+    def may_be_word(slot: int) -> bool:
+        return is_word(slot) or (words_defined and slot_kinds[slot] == SLOT_FREE)
+    # the types we know are on the top of the stack, the last one is the top
+    # Any is a value whose type we don't know, and everything under known could be anything, or nothing at all
+    known: List[ValueType] = []
+    targets = jump_targets(code)
+
+    def pop(count: int) -> List[Optional[ValueType]]:
+        '''pop removes count values from known and returns them, None means the value might not be on the stack'''
+        popped = [None] * (count - len(known)) + known[len(known)-count:]
+        del known[len(known)-count:]
+        return popped
+
+    for ip in range(0, len(code), 2):
+        op, arg = code[ip], code[ip+1]
+        if ip in targets:
+            known[:] = targets[ip]
+        if op == OP_PUSH:
+            known.append(constants[arg][0])
+        elif op == OP_SYMBOL:
+            known.append(ValueType.Symbol)
+        elif (op == OP_NAME or op == OP_LOAD) and not may_be_word(constants[arg][0]):
+            # a constant's type or an address, we can't know which until we run
+            known.append(ValueType.Any)
+        elif op == OP_READ:
+            pop(1)
+            known.append(ValueType.Any)
+        elif op == OP_WRITE:
+            pop(2)
+        elif op in OPERATOR_OPS:
+            a, b = pop(2)
+            _, result_type, numbers_only = OPCODE_OPERATIONS[op]
+            if (a is Number and b is Number) if numbers_only else (a is not None and b is not None):
+                code[ip] = UNCHECKED_OPCODES[op]
+            known.append(result_type)
+        elif op == OP_PUSH_OPERATOR:
+            a, = pop(1)
+            _, _, is_bool, numbers_only, _ = constants[arg]
+            if (a is Number) if numbers_only else (a is not None and a is not ValueType.Any and not EQUALITY_DOMAINS[a]):
+                code[ip] = OP_PUSH_OPERATOR_UNCHECKED
+            known.append(Bool if is_bool else Number)
+        elif op == OP_LOAD_LOAD_OPERATOR and not (may_be_word(constants[arg][0]) or may_be_word(constants[arg][1])):
+            known.append(Bool if constants[arg][3] else Number)
+        elif op == OP_SQUARE:
+            pop(1)
+            known.append(Number)
+        elif op == OP_CALL and (name := function_names.get(constants[arg])) in BUILTIN_EFFECTS:
+            count, pushed = BUILTIN_EFFECTS[name]
+            pop(count)
+            known.extend(pushed)
+        elif op == OP_CALL and name == 'dup':
+            a, = pop(1)
+            # if dup didn't fail the value was there
+            known += [a or ValueType.Any] * 2
+        elif op == OP_BRANCH:
+            pop(1)
+        elif op == OP_LOOP:
+            # start stays on the stack as the index
+            pop(2)
+            known.append(Number)
+        else:
+            # var and con can pop one or two values, and words can do anything, so after them we don't know anything
+            known.clear()
+    return Program(code, constants)
+
+def compile_program(tokens: Iterable[Token], kept: bool = False) -> Program:
+    '''compile_program compiles tokens to bytecode and optimizes it, unless --no-fold, --no-peephole or --no-infer was passed.
+    kept is True for code that's kept and run more than once, see infer_types'''
+    program = compile_bytecode(optimize_tokens(tokens))
+    if peephole:
+        program = optimize(program)
+    return infer_types(program, kept) if infer else program
+
+# the engines we can run compiled tokens with, chosen with --engine=<name>
+ENGINES = {
+    'interpret': interpret,
+    # map keeps the threaded engine lazy so it still works with --stream
+    'threaded': lambda tokens: run_threaded(map(thread_token, optimize_tokens(tokens))),
+    # the vm has to compile the whole program before it can run it
+    'vm': lambda tokens: run_program(compile_program(tokens)),
+}
+
+# the program run by --bench
+# it leaves the stack empty so we can run it over and over
+# constants can't be redefined so BENCH_SETUP runs once before it
+BENCH_SETUP = 'c: 2 con'
+BENCH_SRC = '''
+    a: 3 var b: 4 var
+    a @ b @ + dup * c / 1 - b @ < drop
+    a 10 ! a @ b @ * 2 + c - 100 > drop
+    "hello" length 5 == "world" length 4 != == drop
+    b a @ 1 + ! b @ dup * dup + . 
+''' * 50
+
+import timeit
+def bench(iterations: int = 200):
+    '''bench compares how long each engine in ENGINES takes to run BENCH_SRC. Compiling isn't timed, only execution'''
+    interpret(compile_tokens(tokenize(BENCH_SETUP, location)))
+    tokens = list(compile_tokens(tokenize(BENCH_SRC, location)))
+    # each engine gets its code compiled ahead of time
+    compiled = {
+        'interpret': lambda: interpret(tokens),
+        'threaded': (lambda code: lambda: run_threaded(code))(compile_threaded(tokens)),
+        'vm': (lambda program: lambda: run_program(program))(compile_bytecode(tokens)),
+        'peephole': (lambda program: lambda: run_program(program))(optimize(compile_bytecode(tokens))),
+        'folded': (lambda program: lambda: run_program(program))(optimize(compile_bytecode(fold_constants(tokens)))),
+        'inferred': (lambda program: lambda: run_program(program))(infer_types(optimize(compile_bytecode(fold_constants(tokens))))),
+    }
+    # the program prints, so we throw its output away while timing
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        times = { name: min(timeit.repeat(run, number=iterations, repeat=5)) / iterations for name, run in compiled.items() }
+        # what's left in the buffer belongs to devnull, which is closed once we leave the with
+        output.flush()
+    baseline = times['interpret']
+    for name, seconds in times.items():
+        print(f'{name:>10}: {seconds * 1e3:8.3f} ms per run {baseline / seconds:5.2f}x')
+    bench_stack()
+
+def bench_stack(iterations: int = 200, count: int = 1024):
+    '''bench_stack compares the struct of arrays stack with the list of Value objects it replaced'''
+    # a Value slot is a pointer in the list plus the object and its attribute dict
+    value = Value(ValueType.Number, 0.0)
+    object_bytes = 8 + sys.getsizeof(value) + sys.getsizeof(value.__dict__)
+    # an array slot is one byte for the type plus a pointer in the value list
+    array_bytes = stack_types.itemsize + 8
+    print(f'stack slot: {object_bytes} bytes as Value objects, {array_bytes} bytes as arrays')
+
+    objects = [Value(ValueType.Undefined, UNDEFINED) for _ in range(count)]
+    types = array('B', [ValueType.Undefined]) * count
+    values = [UNDEFINED] * count
+    Number = ValueType.Number
+    number = int(Number)
+    def push_objects():
+        for i in range(count):
+            slot = objects[i]
+            slot.type = Number
+            slot.value = 1.0
+        for i in range(count):
+            slot = objects[i]
+            slot.type is Number and slot.value
+    def push_arrays():
+        for i in range(count):
+            types[i] = number
+            values[i] = 1.0
+        for i in range(count):
+            types[i] == number and values[i]
+    objects_time = min(timeit.repeat(push_objects, number=iterations, repeat=5)) / iterations
+    arrays_time = min(timeit.repeat(push_arrays, number=iterations, repeat=5)) / iterations
+    print(f'push/pop {count} values: {objects_time * 1e6:8.1f} us as Value objects, {arrays_time * 1e6:8.1f} us as arrays {objects_time / arrays_time:5.2f}x')
 
 # bool conversion
 def to_bool():
@@ -801,17 +2819,17 @@ def to_bool():
         error_stack_underflow('to-bool')
 
     # if the top value is a number do nothing
-    if stack[stack_top].type == ValueType.Bool:
+    if stack_types[stack_top] == ValueType.Bool:
         return
     # for now we'll only implement number -> bool
     number_to_bool = stack_invalid_types([ValueType.Number], raise_exception=False, word='to-bool')
 
     if number_to_bool == ():
         # get value
-        value = stack[stack_top]
+        value = stack_values[stack_top]
         # don't modify stack top since we'll push back after popping 
-        stack[stack_top].type = ValueType.Bool
-        stack[stack_top].value = 0.0 if value.value == 0 else 1.0
+        stack_types[stack_top] = ValueType.Bool
+        stack_values[stack_top] = 0.0 if value == 0 else 1.0
     # invalid types
     else:
         _, found, index = number_to_bool
@@ -825,17 +2843,17 @@ def to_number():
         error_stack_underflow('to-number')
 
     # if the top value is a number do nothing
-    if stack[stack_top].type == ValueType.Number:
+    if stack_types[stack_top] == ValueType.Number:
         return
     # for now we'll only implement and bool -> number
     bool_to_number = stack_invalid_types([ValueType.Bool], raise_exception=False, word='to-number')
 
     if bool_to_number == ():
         # get value
-        value = stack[stack_top]
+        value = stack_values[stack_top]
         # don't modify stack top since we'll push back after popping 
-        stack[stack_top].type = ValueType.Number
-        stack[stack_top].value = value.value 
+        stack_types[stack_top] = ValueType.Number
+        stack_values[stack_top] = value 
     # invalid types
     else:
         _, found, index = bool_to_number
@@ -852,12 +2870,12 @@ def builtin_length():
 
     if string_length == ():
         # get value
-        value = stack[stack_top]
+        value = stack_values[stack_top]
         # don't modify stack top since we'll push back after popping 
-        stack[stack_top].type = ValueType.Number
+        stack_types[stack_top] = ValueType.Number
         # push the length of the string as a float
         # note that we need to account for the unescaped string
-        stack[stack_top].value = float(len(value.value))
+        stack_values[stack_top] = float(len(value))
     # invalid types
     else:
         _, found, index = string_length
@@ -875,15 +2893,15 @@ def builtin_append():
 
     if string_append == ():
         # get values
-        b = stack[stack_top]
+        b = stack_values[stack_top]
         stack_top -= 1
 
-        a = stack[stack_top]
+        a = stack_values[stack_top]
         # don't modify stack top since we'll push back after popping 
         # create the appended string
-        new_string = a.value + b.value
+        new_string = a + b
         # push the appended string
-        stack[stack_top].value = new_string
+        stack_values[stack_top] = new_string
     # invalid types
     else:
         _, found, index = string_append
@@ -896,7 +2914,7 @@ def builtin_to_string():
         error_stack_underflow('to-string')
 
     # if the top value is a string do nothing
-    if stack[stack_top].type == ValueType.String:
+    if stack_types[stack_top] == ValueType.String:
         return
 
     # number -> string and bool -> string
@@ -906,21 +2924,22 @@ def builtin_to_string():
 
     if bool_to_string == () or number_to_string == () or symbol_to_string == ():
         # get value
-        value = stack[stack_top]
+        value_type = stack_types[stack_top]
+        value = stack_values[stack_top]
         # don't modify stack top since we'll push back after popping 
         string_value = UNDEFINED
         # number
-        if value.type == ValueType.Number:
-            string_value = str(value.value)
-        elif value.type == ValueType.Symbol:
-            string_value = symbols[value.value][:-1]
+        if value_type == ValueType.Number:
+            string_value = str(value)
+        elif value_type == ValueType.Symbol:
+            string_value = symbol_names[value][:-1]
         # bool
         else:
-            string_value = 'True' if value.value == TRUE else 'False'
+            string_value = 'True' if value == TRUE else 'False'
 
         # set the type and value
-        stack[stack_top].type = ValueType.String
-        stack[stack_top].value = string_value
+        stack_types[stack_top] = ValueType.String
+        stack_values[stack_top] = string_value
     # invalid types
     else:
         _, found, index = bool_to_string
@@ -936,47 +2955,579 @@ def builtin_symbol_from_string():
     stack_invalid_types([ValueType.String], word=word)
 
     # get value
-    v = stack[stack_top]
+    string = stack_values[stack_top]
     # don't modify stack top since we'll push back after popping 
     # set the new value's type to symbol
-    stack[stack_top].type = ValueType.Symbol
-    # get the string from the value
-    string = v.value
+    stack_types[stack_top] = ValueType.Symbol
     # add the traling : if it does not exist
     if not string.endswith(':'):
         string = string + ':'
 
-    # get the hash value
-    hash_value = hash(string)
+    # get the symbol's id
+    symbol_id = intern_symbol(string)
     # assign the new symbol to the symbols table
-    symbols[hash_value] = string
+    symbols[symbol_id] = string
     # push the symbol
-    stack[stack_top].value = hash_value
+    stack_values[stack_top] = symbol_id
 
+def builtin_region():
+    '''builtin_region replaces a region's name with its start address and size in bytes: ( symbol -- number number ), ex. screen: region'''
+    global stack_top
+    if stack_top < 0:
+        error_stack_underflow('region')
+    stack_invalid_types([ValueType.Symbol], word='region')
+    region = MEMORY_REGIONS.get(symbol_names[stack_values[stack_top]][:-1])
+    if region is None:
+        names = ', '.join(name + ':' for name in MEMORY_REGIONS)
+        raise XForthException(f'{location}ERROR: region : Unknown memory region {symbol_names[stack_values[stack_top]]}, expected one of {names}')
+    stack_types[stack_top] = ValueType.Number
+    stack_values[stack_top] = float(region.start)
+    stack_top += 1
+    if stack_top == stack_capacity:
+        stack_grow()
+    stack_types[stack_top] = ValueType.Number
+    stack_values[stack_top] = float(region.size)
+
+def memory_index(word: str, view: memoryview, address: float) -> int:
+    '''memory_index checks that address is a whole number inside of memory and lined up with the size of view's items, then returns its index in view'''
+    size = view.itemsize
+    if not float(address).is_integer() or not 0 <= address <= MEMORY_SIZE - size or address % size != 0:
+        aligned = f' that is a multiple of {size}' if size > 1 else ''
+        raise XForthException(f'{location}ERROR: {word} : Invalid address {address}, expected a whole number from 0 to {MEMORY_SIZE - size}{aligned}')
+    return int(address) // size
+
+def builtin_memory_read(word: str, view: memoryview):
+    '''builtin_memory_read implements the sized reads like f@, it replaces the address on the top of the stack with the number stored there: ( number -- number )'''
+    if stack_top < 0:
+        error_stack_underflow(word)
+    stack_invalid_types([ValueType.Number], word=word)
+    # the type is already Number
+    stack_values[stack_top] = float(view[memory_index(word, view, stack_values[stack_top])])
 
-if __name__ == '__main__':
-    # now since tokenize can through an error we need to also put it in the try block
+def builtin_memory_write(word: str, view: memoryview):
+    '''builtin_memory_write implements the sized writes like f!, it writes the number on the top of the stack to the address under it: ( number number -- )
+    like in C, the integer views drop the fractional part of the number'''
+    global stack_top
+    if stack_top < 1:
+        error_stack_underflow(word)
+    stack_invalid_types([ValueType.Number, ValueType.Number], word=word)
+    value = stack_values[stack_top]
+    index = memory_index(word, view, stack_values[stack_top-1])
     try:
-        tokens = tokenize(src, location)
-        print(f'** TOKENS **\n{tokens}')
+        view[index] = value if view.format == 'd' else int(value)
+    # memoryview raises ValueError when the number doesn't fit in the item, and int raises for nan and inf
+    except (ValueError, OverflowError):
+        raise XForthException(f'{location}ERROR: {word} : Invalid value {value}, it does not fit in {view.itemsize * 8} bits')
+    stack_top -= 2
+
+# X-7 blocks
+def block_program(block: Block) -> Program:
+    '''block_program returns the bytecode for the body of block, compiling it the first time'''
+    if block.program is None:
+        block.program = compile_program(block_tokens(block), kept=True)
+    return block.program
+
+def block_looped(block: Block) -> Program:
+    '''block_looped returns the bytecode for [ ... ] loop with block as the body, compiling it the first time'''
+    if block.looped is None:
+        block.looped = compile_program([Token(TokenType.Loop, block, 'loop')], kept=True)
+    return block.looped
+
+def block_threaded(block: Block) -> ThreadedCode:
+    '''block_threaded returns the threaded code for the body of block, compiling it the first time'''
+    if block.threaded is None:
+        block.threaded = compile_threaded(optimize_tokens(block_tokens(block)))
+    return block.threaded
+
+def call_block(block: Block):
+    '''call_block runs the body of block with the engine the program is running with'''
+    if engine == 'vm':
+        run_program(block_program(block))
+    elif engine == 'threaded':
+        run_threaded(block_threaded(block))
+    else:
+        interpret(block_tokens(block))
 
-        # this version shows debug printing to show that a file is only ever included once 
-        expanded = builtin_expand_includes(tokens, show_info=True)
-        # using this version we expect to see 4 green includes but only 2 yellows
-        # include appeared 4 times,  the file include_another.xf  was passed to include 3 times only actually included once
-        # we'll use this version later on without the debug info shown
-        #expanded = builtin_expand_includes(tokens)
+def builtin_call():
+    '''builtin_call runs the block on the top of the stack, its body works directly on the stack: ( block -- ? ), ex. 2 [ 3 + ] call'''
+    global stack_top
+    if stack_top < 0:
+        error_stack_underflow('call')
+    stack_invalid_types([ValueType.Block], word='call')
+    block = stack_values[stack_top]
+    stack_top -= 1
+    call_block(block)
+
+def builtin_apply():
+    '''builtin_apply runs the block on the top of the stack to push the arguments, then runs the block under it: ( block block -- ? ), ex. [ 3 + ] [ 2 ] apply'''
+    global stack_top
+    if stack_top < 1:
+        error_stack_underflow('apply')
+    stack_invalid_types([ValueType.Block, ValueType.Block], word='apply')
+    arguments = stack_values[stack_top]
+    body = stack_values[stack_top-1]
+    stack_top -= 2
+    call_block(arguments)
+    call_block(body)
+
+# X-8 and X-9
+# these run if and loop when their blocks are only known when the program runs, like body: [ . ] var ... 0 3 body @ loop.
+# When the blocks are written right before the word, lower_control_flow has already compiled them into the code around them
+def builtin_if():
+    '''builtin_if runs the first block if the bool is True and otherwise the second: ( bool block block -- ? ), ex. a @ 10 < [ "less" ] [ "more" ] if'''
+    global stack_top
+    if stack_top < 2:
+        error_stack_underflow('if')
+    stack_invalid_types([ValueType.Block, ValueType.Block, ValueType.Bool], word='if')
+    condition = stack_values[stack_top-2]
+    then_block = stack_values[stack_top-1]
+    else_block = stack_values[stack_top]
+    stack_top -= 3
+    call_block(then_block if condition == TRUE else else_block)
+
+def builtin_loop():
+    '''builtin_loop runs the block once for each number from start up to but not including end, pushing the number first: ( start end block -- ? ), ex. 0 10 [ . ] loop'''
+    global stack_top
+    if stack_top < 2:
+        error_stack_underflow('loop')
+    stack_invalid_types([ValueType.Block, ValueType.Number, ValueType.Number], word='loop')
+    index = stack_values[stack_top-2]
+    end = stack_values[stack_top-1]
+    body = stack_values[stack_top]
+    stack_top -= 3
+    # the index is kept here rather than on the stack, so the block only sees it when it's pushed for each run
+    while index < end:
+        stack_top += 1
+        if stack_top == stack_capacity:
+            stack_grow()
+        stack_types[stack_top] = ValueType.Number
+        stack_values[stack_top] = index
+        call_block(body)
+        index += 1
+
+# tables
+# a block can be used as a table of key value pairs, [ a: 10 b: 20 ] a: get pushes 10.
+# Rather than scanning the pairs on every get, the first get builds a hash index of the block's keys which is kept until put changes the block.
+# Keys are hashed along with their equality domain, so a key matches exactly the values == says it is equal to
+
+# the token type of each value a table can hold
+TABLE_TOKEN_TYPES = { **LITERAL_TOKEN_TYPES, ValueType.Block: TokenType.Block }
+
+def table_value(word: str, block: Block, position: int) -> Tuple[ValueType, Any]:
+    '''table_value returns the type and value of the token at position in a table'''
+    if block.tokens is None:
+        return ValueType.Number, block.numbers[position]
+    kind, value, text = block.tokens[position]
+    if kind is TokenType.Number:
+        return ValueType.Number, value
+    elif kind is TokenType.String:
+        return ValueType.String, value
+    elif kind is TokenType.Bool:
+        return ValueType.Bool, value
+    elif kind is TokenType.Undefined:
+        return ValueType.Undefined, UNDEFINED
+    elif kind is TokenType.Symbol:
+        # like pushing a symbol, a symbol we read from a table goes in the symbols table
+        if not value in symbols:
+            symbols[value] = text
+        return ValueType.Symbol, value
+    elif kind is TokenType.Block:
+        return ValueType.Block, value
+    raise XForthException(f'{location}ERROR: {word} : {block} is not a table, {text} is not a value')
+
+def table_index(word: str, block: Block) -> dict:
+    '''table_index returns the index of block, building it if the block doesn't have one'''
+    if block.index is None:
+        index = {}
+        # a key without a value isn't a pair, so we stop at the last full pair
+        for position in range(0, block_length(block) - 1, 2):
+            key_type, key = table_value(word, block, position)
+            # like a linear search, the first of two equal keys wins
+            index.setdefault((EQUALITY_DOMAINS[key_type], key), position + 1)
+        block.index = index
+    return block.index
+
+def builtin_get():
+    '''builtin_get replaces a table and a key with the key's value in the table, or Undefined if it isn't there: ( block any -- any ), ex. [ a: 10 b: 20 ] a: get'''
+    global stack_top
+    if stack_top < 1:
+        error_stack_underflow('get')
+    stack_invalid_types([ValueType.Any, ValueType.Block], word='get')
+    block = stack_values[stack_top-1]
+    position = table_index('get', block).get((EQUALITY_DOMAINS[stack_types[stack_top]], stack_values[stack_top]))
+    stack_top -= 1
+    if position is None:
+        stack_types[stack_top] = ValueType.Undefined
+        stack_values[stack_top] = UNDEFINED
+    else:
+        stack_types[stack_top], stack_values[stack_top] = table_value('get', block, position)
+
+def table_token(value_type: ValueType, value: Any) -> Token:
+    '''table_token returns a literal token for a value that put is storing in a table'''
+    if value_type == ValueType.Number:
+        # the same as a number written in the block, so the block's text doesn't mix 10 and 30.0
+        text = number_text(value)
+    else:
+        text = get_printed_value(value_type, value)
+    if value_type == ValueType.String:
+        text = '"' + text + '"'
+    return Token(TABLE_TOKEN_TYPES[value_type], value, str(text))
+
+def builtin_put():
+    '''builtin_put sets the value of a key in a table, adding the pair to the end if the key isn't there: ( block any any -- ), ex. b @ c: 30 put'''
+    global stack_top
+    if stack_top < 2:
+        error_stack_underflow('put')
+    stack_invalid_types([ValueType.Any, ValueType.Any, ValueType.Block], word='put')
+    block = stack_values[stack_top-2]
+    for i in (stack_top-1, stack_top):
+        if not VALUE_TYPES[stack_types[i]] in TABLE_TOKEN_TYPES:
+            raise XForthException(f'{location}ERROR: put : Invalid value, a table cannot hold a value of type {VALUE_TYPES[stack_types[i]].name}')
+    key_type, key = VALUE_TYPES[stack_types[stack_top-1]], stack_values[stack_top-1]
+    value_type, value = VALUE_TYPES[stack_types[stack_top]], stack_values[stack_top]
+    index = table_index('put', block)
+    position = index.get((EQUALITY_DOMAINS[key_type], key))
+    # a block of numbers stays packed as long as we only put numbers in it
+    if block.tokens is None and not (key_type == ValueType.Number and value_type == ValueType.Number):
+        block.tokens = block_tokens(block)
+        block.numbers = None
+    if block.tokens is None:
+        items, key_item, value_item = block.numbers, key, value
+    else:
+        items, key_item, value_item = block.tokens, table_token(key_type, key), table_token(value_type, value)
+    if position is None:
+        # a table with a key left over at the end would have its pairs shifted by one
+        if len(items) % 2:
+            raise XForthException(f'{location}ERROR: put : {block} is not a table, its last key has no value')
+        items.append(key_item)
+        items.append(value_item)
+        index[(EQUALITY_DOMAINS[key_type], key)] = len(items) - 1
+    else:
+        items[position] = value_item
+    stack_top -= 3
+    # the index is still right, but the block's text and anything compiled from its old tokens are not
+    block.text = None
+    block.threaded = None
+    block.program = None
+    block.looped = None
+    block.kernel = None
+
+# Numeric Blocks
+# map, filter and reduce call a block for each value in a block. When the block they're given is simple arithmetic on the value,
+# like [ 2 * 1 + ] or [ dup * 10 < ], there's no need to push, call and pop for every value.
+# Instead the block is compiled once into a kernel, an expression tree that is run over every number in one go:
+# with numpy on a view of the array, without it as a Python expression the array is mapped through.
+# Anything else, and any block that isn't all numbers, is handled by calling the block for each value like you'd expect
+import math
+# numpy is optional, without it numeric blocks are still packed arrays and kernels are still compiled
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def block_numbers(word: str, block: Block) -> array:
+    '''block_numbers returns the numbers of a block that only holds numbers'''
+    if block.tokens is None:
+        return block.numbers
+    # an empty block or one that had a non number put in it and back out
+    if all(token.type is TokenType.Number for token in block.tokens):
+        return array('d', (token.value for token in block.tokens))
+    raise XForthException(f'{location}ERROR: {word} : Invalid block, expected a block of numbers but found {block}')
+
+def block_values(word: str, block: Block) -> Iterator[Tuple[ValueType, Any]]:
+    '''block_values yields the type and value of each value in block'''
+    if block.tokens is None:
+        for number in block.numbers:
+            yield ValueType.Number, number
+    else:
+        for position in range(len(block.tokens)):
+            yield table_value(word, block, position)
+
+def make_block(word: str, values: List[Tuple[ValueType, Any]]) -> Block:
+    '''make_block returns a new block holding values, packed if they're all numbers'''
+    if values and all(value_type == ValueType.Number for value_type, _ in values):
+        return Block(None, numbers=array('d', (value for _, value in values)))
+    for value_type, _ in values:
+        if not value_type in TABLE_TOKEN_TYPES:
+            raise XForthException(f'{location}ERROR: {word} : Invalid value, a block cannot hold a value of type {value_type.name}')
+    return Block([ table_token(value_type, value) for value_type, value in values ])
+
+def call_with(word: str, body: Block, arguments: List[Tuple[ValueType, Any]]) -> Tuple[ValueType, Any]:
+    '''call_with pushes arguments, calls body and pops the single value body must leave in their place'''
+    global stack_top
+    depth = stack_top
+    for value_type, value in arguments:
+        stack_top += 1
+        if stack_top == stack_capacity:
+            stack_grow()
+        stack_types[stack_top] = value_type
+        stack_values[stack_top] = value
+    call_block(body)
+    if stack_top != depth + 1:
+        raise XForthException(f'{location}ERROR: {word} : {body} must replace its {len(arguments)} argument(s) with exactly one value')
+    stack_top = depth
+    return VALUE_TYPES[stack_types[depth+1]], stack_values[depth+1]
+
+# kernels
+# a kernel's tree is ('x',) for the value, ('n', number) for a number, or (operator, a, b)
+COMPARISONS = { '<', '>', '==', '!=' }
+
+@dataclass
+class Kernel:
+    '''Kernel is a block of simple arithmetic compiled for map, filter and reduce'''
+    tree: tuple
+    # the tree as a Python function of one number, used when numpy isn't installed
+    function: Callable[[float], Any]
+
+def kernel_tree(body: Block) -> Optional[tuple]:
+    '''kernel_tree returns the expression tree body computes from the value on the top of the stack, or None if it's anything but simple arithmetic'''
+    stack = [('x',)]
+    for token in block_tokens(body):
+        # constants never change, so a number constant is as good as a number
+        if token.type is TokenType.Name:
+            token = constant_literal(token.value) or token
+        kind, value, text = token
+        if kind is TokenType.Number:
+            stack.append(('n', value))
+        elif kind is TokenType.Operator and len(stack) >= 2:
+            b = stack.pop()
+            a = stack.pop()
+            # comparisons give bools, which none of the operators can take as numbers
+            if a[0] in COMPARISONS or b[0] in COMPARISONS:
+                return None
+            stack.append((text, a, b))
+        elif kind is TokenType.Function and text == 'dup':
+            stack.append(stack[-1])
+        else:
+            return None
+    return stack[0] if len(stack) == 1 else None
+
+def kernel_source(tree: tuple, numbers: List[float]) -> str:
+    '''kernel_source returns tree as a Python expression of x, the numbers it uses are added to numbers and read from n'''
+    if tree[0] == 'x':
+        return 'x'
+    if tree[0] == 'n':
+        numbers.append(tree[1])
+        return f'n[{len(numbers) - 1}]'
+    operator, a, b = tree
+    a = kernel_source(a, numbers)
+    b = kernel_source(b, numbers)
+    # divide gives 0.0 when dividing by zero
+    if operator == '/':
+        return f'(0.0 if {b} == 0 else {a} / {b})'
+    return f'({a} {operator} {b})'
+
+def block_kernel(body: Block) -> Optional[Kernel]:
+    '''block_kernel returns the kernel of body or None if it isn't simple arithmetic, compiling it the first time'''
+    if body.kernel is None:
+        tree = kernel_tree(body)
+        if tree is None:
+            body.kernel = False
+        else:
+            numbers = []
+            source = kernel_source(tree, numbers)
+            body.kernel = Kernel(tree, eval(f'lambda x: {source}', { 'n': numbers }))
+    return body.kernel or None
+
+NUMPY_OPERATORS = {
+    '+': 'add', '-': 'subtract', '*': 'multiply',
+    '<': 'less', '>': 'greater', '==': 'equal', '!=': 'not_equal',
+}
 
-        print(f'** INCLUDE EXPANDED TOKENS **\n{expanded}')
+def run_kernel_numpy(tree: tuple, x):
+    '''run_kernel_numpy runs tree over the numpy array x'''
+    if tree[0] == 'x':
+        return x
+    if tree[0] == 'n':
+        return tree[1]
+    operator, a, b = tree
+    a = run_kernel_numpy(a, x)
+    b = run_kernel_numpy(b, x)
+    if operator == '/':
+        zero = numpy.equal(b, 0)
+        return numpy.where(zero, 0.0, numpy.divide(a, numpy.where(zero, 1.0, b)))
+    return getattr(numpy, NUMPY_OPERATORS[operator])(a, b)
+
+def run_kernel(kernel: Kernel, numbers: array):
+    '''run_kernel returns what kernel gives for each of numbers, a numpy array with numpy or a list without it'''
+    if numpy is None:
+        return list(map(kernel.function, numbers))
+    # like Python, numpy gives inf and nan rather than errors, we just don't want its warnings
+    with numpy.errstate(all='ignore'):
+        x = numpy.frombuffer(numbers, dtype=numpy.float64)
+        # a kernel that ignores its value gives a single number
+        return numpy.broadcast_to(run_kernel_numpy(kernel.tree, x), x.shape)
+
+def builtin_map():
+    '''builtin_map calls a block with each value of a block, and pushes a block of the results: ( block block -- block ), ex. [ 1 2 3 ] [ 2 * ] map'''
+    global stack_top
+    if stack_top < 1:
+        error_stack_underflow('map')
+    stack_invalid_types([ValueType.Block, ValueType.Block], word='map')
+    block = stack_values[stack_top-1]
+    body = stack_values[stack_top]
+    kernel = block_kernel(body)
+    if kernel is not None and kernel.tree[0] not in COMPARISONS and block_length(block) and (block.tokens is None or all(t.type is TokenType.Number for t in block.tokens)):
+        results = run_kernel(kernel, block_numbers('map', block))
+        if numpy is not None:
+            results = numpy.ascontiguousarray(results, dtype=numpy.float64).tobytes()
+        result = Block(None, numbers=array('d', results))
+    else:
+        stack_top -= 2
+        result = make_block('map', [ call_with('map', body, [value]) for value in block_values('map', block) ])
+        stack_top += 2
+    stack_top -= 1
+    stack_types[stack_top] = ValueType.Block
+    stack_values[stack_top] = result
 
+def builtin_filter():
+    '''builtin_filter pushes a block of the values of a block that a block gives True for: ( block block -- block ), ex. [ 1 2 3 ] [ 2 > ] filter'''
+    global stack_top
+    if stack_top < 1:
+        error_stack_underflow('filter')
+    stack_invalid_types([ValueType.Block, ValueType.Block], word='filter')
+    block = stack_values[stack_top-1]
+    body = stack_values[stack_top]
+    kernel = block_kernel(body)
+    if kernel is not None and kernel.tree[0] in COMPARISONS and (block.tokens is None or all(t.type is TokenType.Number for t in block.tokens)):
+        numbers = block_numbers('filter', block)
+        if numpy is None:
+            kept = array('d', (number for number, keep in zip(numbers, run_kernel(kernel, numbers)) if keep))
+        else:
+            kept = array('d', numpy.frombuffer(numbers, dtype=numpy.float64)[run_kernel(kernel, numbers)].tobytes())
+        # filtering everything out leaves an empty block, which holds tokens like [ ] does
+        result = Block(None, numbers=kept) if kept else Block([])
+    else:
+        stack_top -= 2
+        kept = []
+        for value in block_values('filter', block):
+            result_type, result = call_with('filter', body, [value])
+            if result_type != ValueType.Bool:
+                raise XForthException(f'{location}ERROR: filter : {body} must leave a Bool but left a {result_type.name}')
+            # remember that True is 0
+            if result == TRUE:
+                kept.append(value)
+        stack_top += 2
+        result = make_block('filter', kept)
+    stack_top -= 1
+    stack_types[stack_top] = ValueType.Block
+    stack_values[stack_top] = result
+
+# the blocks reduce runs without calling them, and how
+REDUCERS = {
+    '+': lambda numbers, start: sum(numbers, start),
+    '*': lambda numbers, start: math.prod(numbers, start=start),
+}
 
-        print(f'\n** INTERPRET **')
-        # pass the expanded tokens now
-        interpret(expanded)
-        # removing pretty_vars for now
-        pretty_vars()
+def builtin_reduce():
+    '''builtin_reduce combines the values of a block into one, starting with a value, by calling a block with the result so far and each value in turn:
+    ( block any block -- any ), ex. [ 1 2 3 ] 0 [ + ] reduce'''
+    global stack_top
+    if stack_top < 2:
+        error_stack_underflow('reduce')
+    stack_invalid_types([ValueType.Block, ValueType.Any, ValueType.Block], word='reduce')
+    block = stack_values[stack_top-2]
+    start_type, start = VALUE_TYPES[stack_types[stack_top-1]], stack_values[stack_top-1]
+    body = stack_values[stack_top]
+    tokens = body.tokens
+    # a block that is just + or *
+    reducer = REDUCERS.get(tokens[0].text) if tokens is not None and len(tokens) == 1 and tokens[0].type is TokenType.Operator else None
+    stack_top -= 3
+    if reducer is not None and start_type == ValueType.Number and (block.tokens is None or all(t.type is TokenType.Number for t in block.tokens)):
+        result_type, result = ValueType.Number, reducer(block_numbers('reduce', block), start)
+    else:
+        result_type, result = start_type, start
+        for value in block_values('reduce', block):
+            result_type, result = call_with('reduce', body, [(result_type, result), value])
+    stack_top += 1
+    if stack_top == stack_capacity:
+        stack_grow()
+    stack_types[stack_top] = result_type
+    stack_values[stack_top] = result
+
+def builtin_sum():
+    '''builtin_sum replaces a block of numbers with their sum: ( block -- number )'''
+    if stack_top < 0:
+        error_stack_underflow('sum')
+    stack_invalid_types([ValueType.Block], word='sum')
+    stack_types[stack_top] = ValueType.Number
+    stack_values[stack_top] = float(sum(block_numbers('sum', stack_values[stack_top])))
+
+def builtin_extreme(word: str, extreme: Callable):
+    '''builtin_extreme implements min and max, it replaces a block of numbers with its smallest or largest number: ( block -- number )'''
+    if stack_top < 0:
+        error_stack_underflow(word)
+    stack_invalid_types([ValueType.Block], word=word)
+    numbers = block_numbers(word, stack_values[stack_top])
+    if not numbers:
+        raise XForthException(f'{location}ERROR: {word} : Invalid block, an empty block has no {word}')
+    stack_types[stack_top] = ValueType.Number
+    stack_values[stack_top] = extreme(numbers)
+
+
+if __name__ == '__main__':
+    # now since tokenize can through an error we need to also put it in the try block
+    try:
+        if engine not in ENGINES:
+            raise XForthException(f'ERROR: Unknown engine {engine}, expected one of: {", ".join(ENGINES)}')
+        if STACK_CAPACITY < 1:
+            raise XForthException(f'ERROR: Invalid stack capacity {stack_limit}, --stack-capacity must be a whole number greater than 0')
+        if RETURN_STACK_CAPACITY < 1:
+            raise XForthException(f'ERROR: Invalid return stack size {return_limit}, --return-stack must be a whole number greater than 0')
+        if flush_rule not in (None, 'line', 'size'):
+            raise XForthException(f'ERROR: Unknown flush rule {flush_rule}, expected line or size')
+        if watch and not args:
+            raise XForthException('ERROR: --watch needs a source file to watch')
+        if image is True:
+            raise XForthException('ERROR: --image needs the path of an image, ex. --image=prelude.img')
+        execute = ENGINES[engine]
+        if disassemble_only:
+            execute = lambda tokens: print(disassemble(compile_program(tokens)))
+        # the image has to be loaded before anything is compiled
+        if image:
+            load_image(image)
+
+        if run_bench:
+            bench()
+        elif watch:
+            watch_source(filename, execute)
+        elif stream and args:
+            # in streaming mode nothing is read until the interpreter asks for the next token
+            # so we skip the debug printing, which would need all of the tokens up front
+            execute(compile_tokens(builtin_expand_includes(stream_file(filename, location))))
+        elif cache and args:
+            cache_dir = cache if cache is not True else os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR)
+            execute(compile_tokens(expand_source(filename, src, location, cache_dir)))
+        else:
+            tokens = tokenize(src, location)
+            print(f'** TOKENS **\n{tokens}')
+
+            # this version shows debug printing to show that a file is only ever included once 
+            expanded = list(builtin_expand_includes(tokens, show_info=True))
+            # using this version we expect to see 4 green includes but only 2 yellows
+            # include appeared 4 times,  the file include_another.xf  was passed to include 3 times only actually included once
+            # we'll use this version later on without the debug info shown
+            #expanded = list(builtin_expand_includes(tokens))
+
+            print(f'** INCLUDE EXPANDED TOKENS **\n{expanded}')
+
+
+            # nothing runs when disassembling, so there is nothing to interpret or show variables for
+            if not disassemble_only:
+                print(f'\n** INTERPRET **')
+            # pass the expanded tokens now
+            execute(compile_tokens(expanded))
+            # removing pretty_vars for now
+            if not disassemble_only:
+                pretty_vars()
     except XForthException as e:
+        output.flush()
         print(e)
+    # the interpreter and the threaded engine call words with Python calls, so they can only go as deep as Python can
+    except RecursionError:
+        output.flush()
+        print(f'{location}ERROR: Return stack overflow, words were called too deeply for the {engine} engine' + ('' if engine == 'vm' else ', the vm can go much deeper, use --engine=vm'))
     except:
+        output.flush()
         print('**DEV ERROR**') 
         traceback.print_exc()